@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive (AIMD) concurrency control and retries for calls to remote services
+(AGDISTIS, the NER server)
+
+The limiter bounds the number of calls in flight. It starts at one call and
+doubles the limit every round trip (slow start) until the service first
+shows signs of overload, then raises it by one call per round trip while the
+latency stays flat (additive increase), up to the configured maximum (the
+size of the request thread pool). When a call fails, or the smoothed latency
+rises above latency_tolerance times its baseline (the lowest smoothed
+latency seen, slowly drifting towards the current latency), the limit is
+halved (multiplicative decrease), at most once per round trip.
+
+Failed calls are retried up to retries times, after a random delay of up to
+backoff * 2^attempt seconds (full jitter), so that the retries of concurrent
+calls are spread out; if the last attempt fails, the error is raised.
+"""
+
+# Standard
+import time
+import random
+import logging
+import threading
+
+# Custom
+import helper_functions as hf
+
+
+class AdaptiveLimiter():
+
+    """
+    AIMD limit on the number of concurrent calls to a service
+    Use call(function, arguments...) to make a call within the limit, with retries
+    """
+
+    def __init__(self, name, max_limit, retries=3, backoff=0.5, max_backoff=30.0, latency_tolerance=2.0):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_tolerance = latency_tolerance
+        self.limit = 1.0
+        self.slow_start = True
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # Smoothed latency, and the lowest smoothed latency (slowly drifting
+        # towards the current latency, so that it follows lasting changes)
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0.0
+        # Statistics
+        self.start = time.time()
+        self.calls = 0
+        self.errors = 0
+        self.failures = 0
+        self.decreases = 0
+        self.peak_limit = 1
+
+
+    def current_limit(self):
+        return min(self.max_limit, int(self.limit))
+
+
+    def acquire(self):
+        """
+        Wait until a call can be made within the limit
+        """
+        with self.condition:
+            while self.in_flight >= self.current_limit():
+                self.condition.wait()
+            self.in_flight += 1
+
+
+    def release(self, latency, error):
+        """
+        Record the outcome of a call and adjust the limit
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if error:
+                self.errors += 1
+                self.decrease('error')
+            else:
+                self.calls += 1
+                if self.latency is None:
+                    self.latency = latency
+                    self.baseline = latency
+                self.latency += 0.05 * (latency - self.latency)
+                self.baseline = min(self.latency, self.baseline + 0.005 * (self.latency - self.baseline))
+                if self.latency > self.latency_tolerance * self.baseline:
+                    self.decrease('latency %.1f ms, baseline %.1f ms' % (1000 * self.latency, 1000 * self.baseline))
+                elif self.slow_start:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.current_limit())
+                self.peak_limit = max(self.peak_limit, self.current_limit())
+            self.condition.notify_all()
+
+
+    def decrease(self, reason):
+        """
+        Halve the limit (at most once per round trip; called with the condition held)
+        """
+        now = time.time()
+        self.slow_start = False
+        if now - self.last_decrease < (self.latency or 0.0) or self.limit <= 1:
+            return
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit / 2)
+        self.decreases += 1
+        logging.info('%s: backing off (%s), limit %d, %.1f calls/sec' %
+                     (self.name, reason, self.current_limit(), self.throughput()))
+
+
+    def throughput(self):
+        return self.calls / max(time.time() - self.start, 1e-9)
+
+
+    def call(self, function, *args):
+        """
+        Call function(*args) within the limit, retrying it if it raises an exception
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            start = time.time()
+            try:
+                result = function(*args)
+            except Exception as e:
+                self.release(time.time() - start, True)
+                if attempt >= self.retries:
+                    with self.condition:
+                        self.failures += 1
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logging.warning('%s: call failed (%s), retrying in %.1f s' % (self.name, e, delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.release(time.time() - start, False)
+            return result
+
+
+    def log_stats(self):
+        """
+        Log the current and peak limit, the throughput and the number of errors
+        """
+        logging.info('%s: limit %d (peak %d, maximum %d, %d decreases), %d calls, %.1f calls/sec, '
+                     '%d errors, %d failed after retries' %
+                     (self.name, self.current_limit(), self.peak_limit, self.max_limit, self.decreases,
+                      self.calls, self.throughput(), self.errors, self.failures))
+
+
+def get_limiter(config, section, name, max_limit):
+    """
+    Create a limiter for a service, reading the retries, backoff and
+    latency_tolerance settings from the given config section
+    """
+    return AdaptiveLimiter(name, max_limit,
+                           retries=hf.get_config_value(config, section, 'retries', 3),
+                           backoff=hf.get_config_value(config, section, 'backoff', 0.5),
+                           latency_tolerance=hf.get_config_value(config, section, 'latency_tolerance', 2.0))
@@ -8,9 +8,14 @@ Handles communication with the AGDISTIS server
 # Standard
 import requests
 import copy
+import logging
+import threading
 from sys import platform
 import time
 
+# Custom
+from adaptive import AdaptiveLimiter
+
 
 class Agdistis(object):
     """
@@ -21,36 +26,90 @@ class Agdistis(object):
         }
     """
     
-    def __init__(self, url):
+    def __init__(self, url, session=None, limiter=None):
         self.agdistisApi = url
         self.defaultAgdistisParams = {
             'text': 'Die Stadt <entity>Dresden</entity> liegt in <entity>Sachsen</entity>',
             'type': 'agdistis'
             } # Change type to 'candidates' to get multiple results with scores (for amiguous entities)
+        # Reuse the given session (keeps connections to the server alive)
+        self.session = session
         # Solution for mac OSX problem whereby requests hang with multiprocessing
         # https://stackoverflow.com/questions/30453152/python-multiprocessing-and-requests
-        if platform == 'darwin': # OSX
+        if self.session is None and platform == 'darwin': # OSX
             self.session = requests.Session()
             self.session.trust_env = False
+        # Request latencies (seconds), and time spent in disambiguate_all
+        self.latencies = []
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+        # Limits the requests in flight, and retries failed requests
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter('AGDISTIS', 1)
 
     def disambiguate(self, text):
         """
             Input: text (any arbitrary string with annotated entities -- <entity>Austria</entity>)
             Output: entities as a list [{'start': 0, 'offset': 7, 'disambiguatedURL': 'http://dbpedia.org/resource/Austria', 'namedEntity': 'Austria'}]
+            Failed requests are retried; if the last attempt fails, the error is raised
+        """
+        return self.limiter.call(self.request, text)
+
+    def request(self, text):
+        """
+            Send a single request (raises an exception if the server fails)
         """
         payload = copy.copy(self.defaultAgdistisParams)
         payload['text'] = text
-        if platform == 'darwin':
+        start = time.time()
+        if self.session is not None:
             r = self.session.post(self.agdistisApi, data=payload)
         else:	
             r = requests.post(self.agdistisApi, data=payload)
             #time.sleep(1)
-        entities = []
+        with self.lock:
+            self.latencies.append(time.time() - start)
+        r.raise_for_status()
+        return r.json()
+
+    def try_disambiguate(self, text):
+        """
+            Disambiguate text, returning None (and logging the error) if the request fails after retries
+        """
         try:
-            entities = r.json()
-        except ValueError as e:            #server failed
-            entities = [{'start': 0, 'offset': 0, 'disambiguatedURL': '', 'namedEntity': ''}]
-        return entities
+            return self.disambiguate(text)
+        except Exception as e:
+            logging.error('AGDISTIS: request failed after retries (%s)' % e)
+            return None
+
+    def disambiguate_all(self, texts, pool=None, skip_failures=False):
+        """
+            Disambiguate a list of texts, with several requests in flight if a (thread) pool is given
+            Output: list of the entities of each text, in the order of the texts
+            If skip_failures is set, the entities of a text whose request failed
+            after retries are None; otherwise the error is raised
+        """
+        start = time.time()
+        function = self.try_disambiguate if skip_failures else self.disambiguate
+        if pool is not None:
+            results = pool.map(function, texts, chunksize=1)
+        else:
+            results = [function(t) for t in texts]
+        self.elapsed += time.time() - start
+        return results
+
+    def log_stats(self):
+        """
+            Log the number of requests, requests/sec and latency percentiles,
+            and the statistics of the request limiter
+        """
+        latencies = sorted(self.latencies)
+        if latencies != []:
+            percentile = lambda p: latencies[min(len(latencies)-1, int(p * len(latencies)))]
+            logging.info('AGDISTIS: %d requests, %.1f requests/sec, latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms' %
+                         (len(latencies), len(latencies) / max(self.elapsed, 1e-9),
+                          1000 * percentile(0.50), 1000 * percentile(0.95), 1000 * percentile(0.99)))
+        # Current request limit and achieved throughput
+        self.limiter.log_stats()
 
     def disambiguateEntity(self, entity):
         """
@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for individual pipeline components
+
+To run a benchmark, use the command: python benchmark.py config.ini <benchmark> [options]
+Available benchmarks:
+    * segmenters - compare the sentence segmentation engines (punkt, udpipe)
+                   on sentences/sec and on sentence boundary agreement
+    * udpipe-modes - compare the UDPipe modes (tokenize, tag, parse) and report
+                     the time saved per million sentences by not parsing
+    * ner-batch - tag the corpus sample with the NER server at different batch sizes
+                  (--batch-sizes) and report sentences/sec, and the agreement of the
+                  tags with those of unbatched requests
+    * ner-io - compare reading the NER input through the intermediate one-token-per-line
+               files with reading it straight from the UDPipe output, per batch
+    * parser-backends - compare the parser backends (udpipe, unstable) on sentences/sec
+                        and on relation yield (candidate relations found in the parse)
+    * dependency-trees - compare loading the parser output into nltk DependencyGraphs
+                         and into compact dependency trees on time and memory
+Benchmarks read their input from the locations specified in config.ini
+and print a summary to stdout.
+"""
+
+# Standard
+import os
+import gc
+import sys
+import time
+import codecs
+import shutil
+import tempfile
+import argparse
+import ConfigParser
+import json
+from itertools import product
+from collections import deque
+from nltk.parse import DependencyGraph
+
+# Custom
+import segmenter as seg
+import ner
+import ner_client
+import helper_functions as hf
+import dependency_tree
+import binary_relation as br
+import unstable_parser_post_proc as postproc
+import resources as res
+import corpus_input as ci
+
+
+def get_config(configfile):
+    """
+    Extract config json from file
+    """
+    cfg = ConfigParser.ConfigParser()
+    cfg.read(configfile)
+    return cfg
+
+
+def read_articles(config, limit):
+    """
+    Read the text of (at most limit) articles from the JSON format corpus file
+    Return a list of articles, each a list of paragraphs
+    """
+    articles = []
+    for chunk in ci.CorpusReader(ci.get_input_files(config), 1024*1024):
+        for line in chunk:
+            if len(articles) == limit:
+                return articles
+            articles.append(json.loads(line)['text'].split('\n'))
+    return articles
+
+
+def sentence_boundaries(segs):
+    """
+    Return the set of sentence end positions of a segmented article
+    Positions are counted in non-whitespace characters, so that they can be
+    compared across segmenters that normalise spaces differently
+    """
+    boundaries = set()
+    position = 0
+    for s in segs:
+        position += len(''.join(s.split()))
+        boundaries.add(position)
+    return boundaries
+
+
+def benchmark_segmenters(config, args):
+    """
+    Compare the sentence segmentation engines
+    Report sentences/sec per engine, and the agreement of the udpipe
+    boundaries with the punkt boundaries (precision, recall, F1)
+    """
+    articles = read_articles(config, args.articles)
+    results = {}
+    for engine in ['punkt', 'udpipe']:
+        config.set('Preprocessor', 'seg_engine', engine)
+        start = time.time()
+        segmenter = seg.get_segmenter(config)
+        load_time = time.time() - start
+        start = time.time()
+        segmented = [segmenter.segment(a) for a in articles]
+        elapsed = time.time() - start
+        sentences = sum(len(s) for s in segmented)
+        results[engine] = segmented
+        print('%-8s load: %.2fs  articles: %d  sentences: %d  time: %.2fs  sentences/sec: %.1f' %
+              (engine, load_time, len(articles), sentences, elapsed, sentences / max(elapsed, 1e-9)))
+    # Boundary agreement (punkt is taken as the reference)
+    agreed = 0
+    punkt_total = 0
+    udpipe_total = 0
+    for p, u in zip(results['punkt'], results['udpipe']):
+        pb = sentence_boundaries(p)
+        ub = sentence_boundaries(u)
+        agreed += len(pb & ub)
+        punkt_total += len(pb)
+        udpipe_total += len(ub)
+    precision = float(agreed) / max(udpipe_total, 1)
+    recall = float(agreed) / max(punkt_total, 1)
+    f1 = 2 * precision * recall / max(precision + recall, 1e-9)
+    print('boundary agreement (udpipe vs punkt)  precision: %.3f  recall: %.3f  F1: %.3f' %
+          (precision, recall, f1))
+
+
+def benchmark_udpipe_modes(config, args):
+    """
+    Time UDPipe tokenisation, tagging and parsing separately on the segmented
+    corpus sample, and report the cost of each mode per million sentences
+    """
+    articles = read_articles(config, args.articles)
+    segs = []
+    for a in articles:
+        segs += seg.get_segmenter(config).segment(a)
+    text = '\n'.join(segs)+'\n'
+    model = res.get_udpipe_model(config.get('UDPipe','model'))
+    start = time.time()
+    sentences = model.tokenize(text)
+    tokenize_time = time.time() - start
+    start = time.time()
+    for s in sentences:
+        model.tag(s)
+    tag_time = time.time() - start
+    start = time.time()
+    for s in sentences:
+        model.parse(s)
+    parse_time = time.time() - start
+    n = max(len(sentences), 1)
+    modes = [('tokenize', tokenize_time),
+             ('tag', tokenize_time + tag_time),
+             ('parse', tokenize_time + tag_time + parse_time)]
+    full = modes[-1][1]
+    print('sentences: %d' % len(sentences))
+    for mode, elapsed in modes:
+        print('%-9s time: %.2fs  sentences/sec: %.1f  sec per million sentences: %.0f  saved vs parse: %.0f' %
+              (mode, elapsed, n / max(elapsed, 1e-9), elapsed / n * 1e6, (full - elapsed) / n * 1e6))
+
+
+def benchmark_ner_batch(config, args):
+    """
+    Tag the segmented corpus sample with the NER server at each batch size
+    Report sentences/sec, the number of misaligned batches (tagged again
+    sentence by sentence), and the fraction of tags that agree with those
+    of unbatched requests (batch size 1)
+    """
+    articles = read_articles(config, args.articles)
+    sentences = []
+    for a in articles:
+        sentences += [s.encode('utf-8').split() for s in seg.get_segmenter(config).segment(a)]
+    endpoints = ner_client.get_endpoints(config)
+    concurrency = hf.get_config_value(config, 'StanfordNER', 'concurrency', len(endpoints))
+    print('sentences: %d' % len(sentences))
+    reference = None
+    for batch_size in [1] + [b for b in args.batch_sizes if b != 1]:
+        client = ner_client.NerClient(endpoints, batch_size, concurrency)
+        start = time.time()
+        tagged = client.tag_sentences(sentences)
+        elapsed = time.time() - start
+        client.close()
+        if reference is None:
+            reference = tagged
+        tags = [t[1] for sent in tagged for t in sent]
+        reference_tags = [t[1] for sent in reference for t in sent]
+        agreement = float(sum(1 for t, r in zip(tags, reference_tags) if t == r)) / max(len(reference_tags), 1)
+        print('batch size %-5d time: %.2fs  sentences/sec: %.1f  misaligned batches: %d  tag agreement: %.4f' %
+              (batch_size, elapsed, len(sentences) / max(elapsed, 1e-9), client.fallbacks, agreement))
+
+
+def benchmark_ner_io(config, args):
+    """
+    Read the NER input of every batch in the UDPipe output directory in two ways:
+    via the intermediate one-token-per-line file (written and read back, as the
+    NER step did before), and straight from the UDPipe output
+    Report the bytes of intermediate I/O and the wall-clock time saved per batch
+    """
+    home = config.get('General','home')
+    indir = home + '/' + config.get('UDPipe','out_dir')
+    files = sorted(f for f in os.listdir(indir) if not f.startswith('.'))
+    tmpdir = tempfile.mkdtemp(dir=home)
+    config.set('NER', 'pre_proc_out_dir', os.path.basename(tmpdir))
+    ner_step = ner.Ner(config)
+    direct_time = 0.0
+    intermediate_time = 0.0
+    intermediate_bytes = 0
+    mismatches = 0
+    try:
+        for f in files:
+            start = time.time()
+            direct = list(ner_step.extract_sentences(indir + '/' + f))
+            direct_time += time.time() - start
+            start = time.time()
+            ner_step.pre_process_ner([f])
+            sentences = []
+            with open(tmpdir + '/' + f, 'r') as infile:
+                tokens = []
+                for line in infile:
+                    if line == '\n':
+                        sentences.append(tokens)
+                        tokens = []
+                    else:
+                        tokens.append(line.rstrip('\n'))
+            intermediate_time += time.time() - start
+            # The file is written once and read once
+            intermediate_bytes += 2 * os.path.getsize(tmpdir + '/' + f)
+            if sentences != direct:
+                mismatches += 1
+    finally:
+        shutil.rmtree(tmpdir)
+    n = max(len(files), 1)
+    print('batches: %d  batches with different input: %d' % (len(files), mismatches))
+    print('intermediate files  time per batch: %.4fs  I/O per batch: %.1f KB' %
+          (intermediate_time / n, intermediate_bytes / 1024.0 / n))
+    print('direct              time per batch: %.4fs  I/O per batch: 0.0 KB' % (direct_time / n))
+    print('saved per batch: %.4fs, %.1f KB' %
+          ((intermediate_time - direct_time) / n, intermediate_bytes / 1024.0 / n))
+
+
+def token_tags(dt):
+    """
+    Return the (address, coarse tag) of each token of a dependency tree: read
+    from the tag list of a compact tree, from the nodes of a DependencyGraph
+    """
+    if isinstance(dt, dependency_tree.DependencyTree):
+        return enumerate(dt.ctag[1:], 1)
+    return [(i, dt.nodes[i]['ctag']) for i in sorted(dt.nodes) if i != 0]
+
+
+def candidate_relations(dtrees):
+    """
+    Find the candidate relations in the dependency trees of a parse file, using
+    proper noun spans in place of named entities and noun spans as common entities
+    Return the set of (sentence, entity start, entity start) triples that
+    binary_relation.is_candidate_pair accepts
+    """
+    candidates = set()
+    for x in range(0,len(dtrees)):
+        dt = dtrees[x]
+        # Entity spans: runs of PROPN ("ner") or NOUN ("com") tokens
+        spans = {}
+        prev_tag = None
+        for node_index, tag in token_tags(dt):
+            if tag in ['PROPN', 'NOUN'] and tag != prev_tag:
+                spans[node_index] = 'ner' if tag == 'PROPN' else 'com'
+            prev_tag = tag
+        for start1, start2 in product(spans.keys(), repeat=2):
+            if start1 == start2 or (spans[start1] == 'com' and spans[start2] == 'com'):
+                continue
+            if br.is_candidate_pair(dt, start1, start2):
+                candidates.add((x, start1, start2))
+    return candidates
+
+
+def benchmark_parser_backends(config, args):
+    """
+    Parse the segmented corpus sample with each parser backend: udpipe (UDPipe
+    tags and parses), and unstable (UDPipe tags, the UnstableParser parses and
+    the output is post-processed), skipped if the UnstableParser cannot be loaded
+    Report sentences/sec (the time to load the UnstableParser model is reported
+    separately, as the parser service loads it once per run), the candidate
+    relations per 100 sentences, and the candidate relations found by both
+    """
+    articles = read_articles(config, args.articles)
+    segs = []
+    for a in articles:
+        segs += seg.get_segmenter(config).segment(a)
+    text = '\n'.join(segs)+'\n'
+    model = res.get_udpipe_model(config.get('UDPipe','model'))
+    outformat = 'conllu'
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    try:
+        start = time.time()
+        sentences = model.tokenize(text)
+        for s in sentences:
+            model.tag(s)
+        tag_time = time.time() - start
+        # Tagged input of the UnstableParser (written before parsing modifies the sentences)
+        with codecs.open(tmpdir + '/tagged', 'w', 'utf-8') as o:
+            o.write(model.write(sentences, outformat))
+        start = time.time()
+        for s in sentences:
+            model.parse(s)
+        parse_time = time.time() - start
+        with codecs.open(tmpdir + '/udpipe', 'w', 'utf-8') as o:
+            o.write(model.write(sentences, outformat))
+        results.append(('udpipe', tag_time + parse_time, 0.0, tmpdir + '/udpipe'))
+        try:
+            sys.path.insert(0, config.get('UnstableParser','path'))
+            import unstable_parser as up
+            start = time.time()
+            uparser = up.UnstableParser(config.get('UnstableParser','path'), config.get('UnstableParser','save_dir'))
+            load_time = time.time() - start
+            os.mkdir(tmpdir + '/parsed')
+            os.mkdir(tmpdir + '/restored')
+            start = time.time()
+            uparser.parse(tmpdir + '/parsed', [tmpdir + '/tagged'])
+            postproc.restore(tmpdir + '/tagged', tmpdir + '/parsed/tagged', tmpdir + '/restored')
+            parse_time = time.time() - start
+            results.append(('unstable', tag_time + parse_time, load_time, tmpdir + '/restored/tagged'))
+        except Exception as e:
+            print('unstable backend skipped: cannot run the UnstableParser (%s)' % e)
+        print('sentences: %d' % len(sentences))
+        found = []
+        for backend, elapsed, load_time, parsefile in results:
+            dtrees = hf.dependency_parse_to_graph(parsefile)
+            n = len(dtrees)
+            candidates = candidate_relations(dtrees)
+            found.append(candidates)
+            print('%-9s time: %.2fs  sentences/sec: %.1f  model loading: %.2fs  candidate relations: %d  per 100 sentences: %.1f' %
+                  (backend, elapsed, n / max(elapsed, 1e-9), load_time, len(candidates),
+                   100.0 * len(candidates) / max(n, 1)))
+        if len(found) == 2:
+            print('candidate relations found by both backends: %d' % len(found[0] & found[1]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def nltk_dependency_parse_to_graph(filename):
+    """
+    Read dependency parser output into nltk DependencyGraphs (as the pipeline did
+    before the compact trees)
+    """
+    data = ''
+    dtree = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line[0] != '#':
+                if 'root' in line:
+                    elements = line.split('\t')
+                    if elements[7] == 'root':
+                        elements[7] = 'ROOT'
+                        line = '\t'.join(elements)
+                data += line
+                if line == '\n':
+                    dg = DependencyGraph(data.decode('utf8'))
+                    dtree.append(dg)
+                    data = ''
+    return dtree
+
+
+def nltk_extract_entities(dgraphs, postag):
+    """
+    Extract all tokens / multi-token spans from nltk DependencyGraphs (as
+    hf.extract_entities_from_dependency_parse did before the compact trees)
+    """
+    sents = []
+    for dg in dgraphs:
+        tok_list = []
+        for node_index in dg.nodes:
+            if node_index != 0:
+                node = dg.nodes[node_index]
+                tok_list.append((node['word'], postag if node['ctag'] == postag else 'O'))
+        sents.append(tok_list)
+    return sents
+
+
+def deep_size(obj, seen):
+    """
+    Memory used by an object and the objects it references (each counted once,
+    objects in seen are not counted)
+    """
+    size = 0
+    todo = deque([obj])
+    while todo:
+        o = todo.popleft()
+        if id(o) in seen or callable(o) or isinstance(o, type):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            todo.extend(o.keys())
+            todo.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            todo.extend(o)
+        if hasattr(o, '__dict__'):
+            todo.append(o.__dict__)
+        for slot in getattr(type(o), '__slots__', ()):
+            if hasattr(o, slot):
+                todo.append(getattr(o, slot))
+    return size
+
+
+def node_values(dt, i):
+    node = dt.nodes[i]
+    deps = dict((rel, list(children)) for rel, children in node['deps'].items() if children != [])
+    return (node['word'], node['lemma'], node['ctag'], node['tag'], node['head'], node['rel'], deps)
+
+
+def benchmark_dependency_trees(config, args):
+    """
+    Load the dependency parses in the post-processed parser output directory
+    into nltk DependencyGraphs and into compact dependency trees
+    Report the load time, the memory held by the trees (and by the trees once
+    read: the compact trees build only the nodes that are read), the time to
+    read them as the pipeline does (extract the nouns, as entity linking does,
+    and find the candidate relations between noun spans, as binary relation
+    extraction does) and the sentences on which the trees differ
+    Each file is loaded and read in turn, as the pipeline does, with only its
+    own trees in memory; the memory is summed over the files
+    """
+    home = config.get('General','home')
+    indir = home + '/' + config.get('UnstableParser','post_proc_out_dir')
+    files = sorted(f for f in os.listdir(indir) if not f.startswith('.'))
+    results = []
+    readers = [('nltk', nltk_dependency_parse_to_graph, nltk_extract_entities),
+               ('compact', dependency_tree.read_dependency_trees, hf.extract_entities_from_dependency_parse)]
+    for name, loader, extract_entities in readers:
+        load_time = 0.0
+        read_time = 0.0
+        memory = 0
+        read_memory = 0
+        candidates = 0
+        for f in files:
+            gc.collect()
+            start = time.time()
+            dtrees = loader(indir + '/' + f)
+            load_time += time.time() - start
+            # The interned tag and relation strings of the compact trees are counted once per file
+            memory += deep_size(dtrees, set())
+            start = time.time()
+            extract_entities(dtrees, 'NOUN')
+            candidates += len(candidate_relations(dtrees))
+            read_time += time.time() - start
+            read_memory += deep_size(dtrees, set())
+        results.append((name, load_time, memory, read_time, read_memory, candidates))
+    # Compare the trees file by file
+    sentences = 0
+    mismatches = 0
+    for f in files:
+        nltk_trees = nltk_dependency_parse_to_graph(indir + '/' + f)
+        compact_trees = dependency_tree.read_dependency_trees(indir + '/' + f)
+        sentences += len(nltk_trees)
+        if len(nltk_trees) != len(compact_trees):
+            mismatches += max(len(nltk_trees), len(compact_trees))
+            continue
+        for dg, dt in zip(nltk_trees, compact_trees):
+            if (sorted(dg.nodes) != list(dt.nodes) or
+                any(node_values(dg, i) != node_values(dt, i) for i in dt.nodes)):
+                mismatches += 1
+    print('files: %d  sentences: %d  sentences on which the trees differ: %d' % (len(files), sentences, mismatches))
+    for name, load_time, memory, read_time, read_memory, candidates in results:
+        print('%-8s load time: %.2fs  sentences/sec: %.1f  memory: %.1f MB (%.0f bytes per sentence)  '
+              'reading: %.2fs (%d candidate relations)  memory once read: %.1f MB' %
+              (name, load_time, sentences / max(load_time, 1e-9), memory / 1048576.0,
+               memory / float(max(sentences, 1)), read_time, candidates, read_memory / 1048576.0))
+
+BENCHMARKS = {
+    'segmenters': benchmark_segmenters,
+    'udpipe-modes': benchmark_udpipe_modes,
+    'ner-batch': benchmark_ner_batch,
+    'ner-io': benchmark_ner_io,
+    'parser-backends': benchmark_parser_backends,
+    'dependency-trees': benchmark_dependency_trees,
+}
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Benchmark pipeline components')
+    argparser.add_argument('config', help='pipeline configuration file (config.ini)')
+    argparser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    argparser.add_argument('--articles', type=int, default=1000,
+                           help='number of corpus articles to use (default: 1000)')
+    argparser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 5, 10, 20, 50, 100],
+                           help='NER batch sizes to compare (ner-batch benchmark)')
+    args = argparser.parse_args()
+    BENCHMARKS[args.benchmark](get_config(args.config), args)
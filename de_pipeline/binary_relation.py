@@ -17,6 +17,29 @@ from collections import OrderedDict
 import helper_functions as hf
 
 
+# Dependency relations of the two arguments of a binary relation
+SUBJECT_RELATIONS = ['nsubj', 'nsubj:pass','dep']
+OBJECT_RELATIONS = ['obj', 'obl','dep']
+
+
+def is_candidate_pair(dt, tok1, tok2):
+    """
+    Check whether the entities starting at tokens tok1 and tok2 of a dependency
+    tree can be the arguments of a binary relation: the first is the subject and
+    the second the object of the same predicate (or of an open clausal
+    complement (xcomp) of the predicate)
+    """
+    ent1rel = dt.nodes[tok1]['rel']
+    ent2rel = dt.nodes[tok2]['rel']
+    if ent1rel not in SUBJECT_RELATIONS or ent2rel not in OBJECT_RELATIONS:
+        return False
+    ent1head = dt.nodes[tok1]['head']
+    ent2head = dt.nodes[tok2]['head']
+    ent2headhead = dt.nodes.get(ent2head)['head']
+    ent2headrel= dt.nodes.get(ent2head)['rel']
+    return ent1head == ent2head or (ent2headhead == ent1head and ent2headrel == 'xcomp')
+
+
 class BinaryRelation():
 
     """
@@ -163,11 +186,11 @@ class BinaryRelation():
 
     def get_sentence(self, dt):
         """
-        Extract the sentence text from the dependency tree
+        Extract the sentence text from the dependency tree (from its word
+        list, without building its nodes)
         """
         t = []
-        for node_index in dt.nodes:
-            word = dt.nodes[node_index]['word']
+        for word in dt.word:
             if word:
                 t.append(word)
         s = ' '.join(t)
@@ -240,30 +263,24 @@ class BinaryRelation():
         pred_string = ''
         pred_index = -1
         passive = False
-        ent1rel = dt.nodes[ent1['starttok']]['rel']
-        ent2rel = dt.nodes[ent2['starttok']]['rel']
-        if ent1rel in ['nsubj', 'nsubj:pass','dep'] and ent2rel in ['obj', 'obl','dep']:
-            if ent1rel == 'nsubj:pass':
+        if is_candidate_pair(dt, ent1['starttok'], ent2['starttok']):
+            if dt.nodes[ent1['starttok']]['rel'] == 'nsubj:pass':
                 passive = True
             ent1head = dt.nodes[ent1['starttok']]['head']
-            ent2head = dt.nodes[ent2['starttok']]['head']
-            ent2headhead = dt.nodes.get(ent2head)['head']
-            ent2headrel= dt.nodes.get(ent2head)['rel']
-            if ent1head == ent2head or (ent2headhead == ent1head and ent2headrel == 'xcomp'):
-                pred_string = dt.nodes[ent1head]['lemma']
-                pred_index = ent1head
-                # Check if predicate is a particle verb
-                if 'compound:prt' in dt.nodes[ent1head]['deps']:
-                    for prt in dt.nodes[ent1head]['deps']['compound:prt']:
-                        pred_string += '_' + dt.nodes[prt]['lemma']
-                # Add modifiers to verbs
-                mods = self.get_modifiers_to_verb(dt, pred_index, [])
-                for mod in mods:
-                    pred_string += '.' + dt.nodes[mod]['lemma']
-                # Add prepositions
-                if 'case' in dt.nodes[ent2['starttok']]['deps']:
-                    for prep in dt.nodes[ent2['starttok']]['deps']['case']:
-                        pred_string += '.' + dt.nodes[prep]['lemma']
+            pred_string = dt.nodes[ent1head]['lemma']
+            pred_index = ent1head
+            # Check if predicate is a particle verb
+            if 'compound:prt' in dt.nodes[ent1head]['deps']:
+                for prt in dt.nodes[ent1head]['deps']['compound:prt']:
+                    pred_string += '_' + dt.nodes[prt]['lemma']
+            # Add modifiers to verbs
+            mods = self.get_modifiers_to_verb(dt, pred_index, [])
+            for mod in mods:
+                pred_string += '.' + dt.nodes[mod]['lemma']
+            # Add prepositions
+            if 'case' in dt.nodes[ent2['starttok']]['deps']:
+                for prep in dt.nodes[ent2['starttok']]['deps']['case']:
+                    pred_string += '.' + dt.nodes[prep]['lemma']
         return (pred_string, pred_index, passive)
 
 
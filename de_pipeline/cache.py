@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent on-disk caches shared by all worker processes
+
+PersistentCache is a key/value store in an SQLite database. Values are
+stored as JSON. The database is opened in write-ahead-logging mode so that
+many processes can read and write it concurrently, and the least recently
+used entries are evicted once it holds more than max_entries entries (the
+number of entries is kept in the database, and updated by every write).
+
+SentenceCache stores the output of one pipeline stage (e.g. NER tags, a
+dependency parse, entity linking results) keyed by a hash of the normalised
+sentence, and counts hits and misses.
+
+EntityCache stores the DBPedia URL that each entity (surface form) was
+linked to. A surface form that has been linked to different URLs in
+different sentences is marked as ambiguous; its links are then stored and
+looked up by surface form and context signature (a hash of the other entities
+in the sentence), or not cached at all if context signatures are disabled.
+"""
+
+# Standard
+import os
+import re
+import time
+import logging
+import hashlib
+import sqlite3
+import simplejson as json
+
+# Custom
+import helper_functions as hf
+
+
+# Open caches, keyed by (path, process ID): SQLite connections must not be
+# shared with the worker processes forked after they were opened
+_stores = {}
+
+
+class PersistentCache():
+
+    """
+    SQLite-backed key/value store with least-recently-used eviction
+    Entries older than ttl seconds (if given) are treated as absent
+    Writes (and updates of the last-used times of entries that were read)
+    are buffered, and written to the database in a single transaction every
+    flush_interval operations, or when flush is called
+    """
+
+    def __init__(self, path, max_entries, flush_interval=100, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.connection.text_factory = str
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, '
+                                'used REAL, created REAL, PRIMARY KEY (namespace, key))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+        self.upgrade()
+        # Buffered writes: (namespace, key) -> JSON value
+        self.pending = {}
+        # Buffered last-used times: (namespace, key) -> time
+        self.touched = {}
+
+
+    def upgrade(self):
+        """
+        Add what a new cache, or a cache written by an earlier version, lacks:
+            * the creation time column (the entries are taken to have been
+              created when they were last used), and its index for expiry
+            * the table holding the number of entries
+        """
+        if self.is_upgraded():
+            return
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have upgraded the cache in the meantime
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(cache)')]
+            if 'created' not in columns:
+                self.connection.execute('ALTER TABLE cache ADD COLUMN created REAL DEFAULT 0')
+                self.connection.execute('UPDATE cache SET created=used')
+                logging.info('cache %s: added the entry creation times' % self.path)
+            self.connection.execute('CREATE INDEX IF NOT EXISTS cache_created ON cache (created)')
+            if self.connection.execute("SELECT name FROM sqlite_master WHERE name='cache_size'").fetchone() is None:
+                self.connection.execute('CREATE TABLE cache_size (entries INTEGER)')
+                self.connection.execute('INSERT INTO cache_size SELECT COUNT(*) FROM cache')
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+
+
+    def is_upgraded(self):
+        """
+        Check whether the cache has the creation time column, its index and the entry count
+        """
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(cache)')]
+        names = [row[0] for row in self.connection.execute("SELECT name FROM sqlite_master "
+                                                           "WHERE name IN ('cache_created', 'cache_size')")]
+        return 'created' in columns and len(names) == 2
+
+
+    def get(self, namespace, key):
+        """
+        Return the value stored for key, or None if there is none
+        """
+        if (namespace, key) in self.pending:
+            return json.loads(self.pending[(namespace, key)])
+        row = self.connection.execute('SELECT value, created FROM cache WHERE namespace=? AND key=?',
+                                      (namespace, key)).fetchone()
+        if row is None:
+            return None
+        if self.ttl and row[1] < time.time() - self.ttl:
+            return None
+        self.touched[(namespace, key)] = time.time()
+        self.maybe_flush()
+        return json.loads(row[0])
+
+
+    def put(self, namespace, key, value):
+        """
+        Store a value for key
+        """
+        self.pending[(namespace, key)] = json.dumps(value)
+        self.maybe_flush()
+
+
+    def maybe_flush(self):
+        """
+        Flush the buffered operations once there are flush_interval of them
+        """
+        if len(self.pending) + len(self.touched) >= self.flush_interval:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Write the buffered values and last-used times to the database,
+        and evict the least recently used entries if the cache is full
+        """
+        if self.pending == {} and self.touched == {}:
+            return
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Replace the stored entries, then insert the new ones (counting them)
+            rows = [(v, now, now, ns, k) for ((ns, k), v) in self.pending.iteritems()]
+            self.connection.executemany('UPDATE cache SET value=?, used=?, created=? WHERE namespace=? AND key=?', rows)
+            added = self.connection.executemany('INSERT OR IGNORE INTO cache (value, used, created, namespace, key) '
+                                                'VALUES (?,?,?,?,?)', rows).rowcount
+            self.add_to_size(added)
+            self.connection.executemany('UPDATE cache SET used=? WHERE namespace=? AND key=?',
+                                        [(t, ns, k) for ((ns, k), t) in self.touched.iteritems()])
+            if self.pending != {}:
+                self.evict()
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.pending = {}
+        self.touched = {}
+
+
+    def evict(self):
+        """
+        Delete the expired entries, and the least recently used entries in excess of max_entries
+        """
+        if self.ttl:
+            expired = self.connection.execute('DELETE FROM cache WHERE created < ?', (time.time() - self.ttl,)).rowcount
+            self.add_to_size(-expired)
+        count = self.connection.execute('SELECT entries FROM cache_size').fetchone()[0]
+        if count > self.max_entries:
+            evicted = self.connection.execute('DELETE FROM cache WHERE rowid IN '
+                                              '(SELECT rowid FROM cache ORDER BY used LIMIT ?)',
+                                              (count - self.max_entries,)).rowcount
+            self.add_to_size(-evicted)
+
+
+    def add_to_size(self, change):
+        """
+        Update the number of entries (within the transaction of the change)
+        """
+        if change != 0:
+            self.connection.execute('UPDATE cache_size SET entries = entries + ?', (change,))
+
+
+def normalise_sentence(sentence):
+    """
+    Normalise a sentence for use as a cache key: collapse whitespace
+    """
+    if isinstance(sentence, unicode):
+        sentence = sentence.encode('utf-8')
+    return ' '.join(sentence.split())
+
+
+class SentenceCache():
+
+    """
+    Cache of the output of one pipeline stage, keyed by the hash of the
+    normalised sentence, with hit and miss counters
+    """
+
+    def __init__(self, store, stage):
+        self.store = store
+        self.stage = stage
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, sentence):
+        """
+        Content address of a sentence
+        """
+        return hashlib.sha1(normalise_sentence(sentence)).hexdigest()
+
+
+    def get(self, sentence):
+        """
+        Return the cached output for sentence, or None if it is not cached
+        """
+        value = self.store.get(self.stage, self.key(sentence))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+
+    def put(self, sentence, value):
+        """
+        Cache the output for sentence
+        """
+        self.store.put(self.stage, self.key(sentence), value)
+
+
+    def close(self):
+        """
+        Write any buffered entries to disk and log the hit and miss counts
+        """
+        self.store.flush()
+        total = self.hits + self.misses
+        logging.info('sentence cache (%s): %d hits, %d misses (%.1f%% hit rate)' %
+                     (self.stage, self.hits, self.misses, 100.0 * self.hits / max(total, 1)))
+
+
+def get_sentence_cache(config, stage):
+    """
+    Return the sentence cache for a pipeline stage, or None if the sentence
+    cache is not enabled in config ([SentenceCache] enabled)
+    """
+    if not hf.get_config_value(config, 'SentenceCache', 'enabled', False):
+        return None
+    path = hf.get_config_value(config, 'SentenceCache', 'path', 'sentence_cache.db')
+    if not os.path.isabs(path):
+        path = config.get('General','home') + '/' + path
+    key = (path, os.getpid())
+    if key not in _stores:
+        max_entries = hf.get_config_value(config, 'SentenceCache', 'max_entries', 1000000)
+        _stores[key] = PersistentCache(path, max_entries)
+    return SentenceCache(_stores[key], stage)
+
+
+class EntityCache():
+
+    """
+    Cache of entity links, keyed by surface form (and by context signature
+    for ambiguous surface forms), with hit and miss counters
+    """
+
+    entity_pattern = re.compile(u'<entity>(.*?)</entity>')
+
+
+    def __init__(self, store, use_context):
+        self.store = store
+        self.use_context = use_context
+        self.hits = 0
+        self.misses = 0
+        # Number of sentences linked without a request to the entity linker
+        self.sentences = 0
+
+
+    def mentions(self, formatted_sent):
+        """
+        Return the (surface form, start) of each entity in a sentence with
+        <entity></entity> tags; start is the character offset of the entity
+        in the sentence without the tags
+        """
+        mentions = []
+        removed = 0
+        for match in self.entity_pattern.finditer(formatted_sent.decode('utf-8')):
+            mentions.append((match.group(1), match.start() - removed))
+            removed += len('<entity>') + len('</entity>')
+        return mentions
+
+
+    def context_key(self, surface, surfaces):
+        """
+        Key of a surface form in the context of the other entities of its sentence
+        """
+        context = '\t'.join(sorted(set(s.encode('utf-8') for s in surfaces if s != surface)))
+        return surface.encode('utf-8') + '\t' + hashlib.sha1(context).hexdigest()
+
+
+    def lookup(self, surface, surfaces):
+        """
+        Return the cached URL of an entity, or None if it is not cached
+        """
+        url = None
+        entry = self.store.get('surface', surface.encode('utf-8'))
+        if entry is not None and not entry['ambiguous']:
+            url = entry['url']
+        elif entry is not None and self.use_context:
+            entry = self.store.get('context', self.context_key(surface, surfaces))
+            if entry is not None:
+                url = entry['url']
+        if url is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return url
+
+
+    def link(self, formatted_sent):
+        """
+        Return the linked entities of a sentence (in the format returned by
+        AGDISTIS) if all of them are cached, otherwise None
+        """
+        mentions = self.mentions(formatted_sent)
+        surfaces = [m[0] for m in mentions]
+        entities = []
+        for surface, start in mentions:
+            url = self.lookup(surface, surfaces)
+            if url is None:
+                return None
+            entities.append({'namedEntity': surface, 'start': start, 'offset': len(surface),
+                             'disambiguatedURL': url})
+        self.sentences += 1
+        return entities
+
+
+    def add(self, formatted_sent, entities):
+        """
+        Cache the links of the entities of a sentence (as returned by AGDISTIS)
+        """
+        mentions = self.mentions(formatted_sent)
+        surfaces = [m[0] for m in mentions]
+        starts = dict((start, surface) for surface, start in mentions)
+        for e in entities:
+            surface = starts.get(e['start'])
+            if surface is None or e['offset'] != len(surface):
+                continue
+            url = e['disambiguatedURL']
+            key = surface.encode('utf-8')
+            entry = self.store.get('surface', key)
+            if entry is None:
+                self.store.put('surface', key, {'url': url, 'ambiguous': False})
+                continue
+            if not entry['ambiguous']:
+                if entry['url'] == url:
+                    continue
+                # Linked to a different entity than before: the surface form is ambiguous
+                self.store.put('surface', key, {'url': None, 'ambiguous': True})
+            if self.use_context:
+                self.store.put('context', self.context_key(surface, surfaces), {'url': url})
+
+
+    def close(self):
+        """
+        Write any buffered entries to disk and log the hit and miss counts
+        """
+        self.store.flush()
+        total = self.hits + self.misses
+        logging.info('entity cache: %d sentences linked from the cache, %d hits, %d misses (%.1f%% hit rate)' %
+                     (self.sentences, self.hits, self.misses, 100.0 * self.hits / max(total, 1)))
+
+
+def get_entity_cache(config):
+    """
+    Return the entity link cache, or None if it is not enabled
+    in config ([EntityCache] enabled)
+    """
+    if not hf.get_config_value(config, 'EntityCache', 'enabled', False):
+        return None
+    path = hf.get_config_value(config, 'EntityCache', 'path', 'entity_cache.db')
+    if not os.path.isabs(path):
+        path = config.get('General','home') + '/' + path
+    key = (path, os.getpid())
+    if key not in _stores:
+        max_entries = hf.get_config_value(config, 'EntityCache', 'max_entries', 1000000)
+        ttl = hf.get_config_value(config, 'EntityCache', 'ttl', 30*24*3600)
+        _stores[key] = PersistentCache(path, max_entries, ttl=ttl)
+    return EntityCache(_stores[key], hf.get_config_value(config, 'EntityCache', 'context', True))
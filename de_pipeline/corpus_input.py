@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming input of the JSON format corpus
+
+The corpus may be a single JSONL file or a glob pattern matching many files
+(e.g. "*.jsonl.gz"). Files compressed with gzip (.gz) or xz (.xz) are
+decompressed on the fly, never to disk. Each file is read by its own thread
+(at most "prefetch" files at a time) into a bounded queue, so decompression
+overlaps with segmentation and memory use does not depend on corpus size.
+"""
+
+# Standard
+import io
+import glob
+import gzip
+import threading
+import Queue
+try:
+    import lzma
+except ImportError:
+    from backports import lzma
+
+
+def get_input_files(config):
+    """
+    Return the sorted list of corpus files matching the Input settings in config
+    """
+    home = config.get('General','home')
+    indir = config.get('Input','json_dir')
+    infile = config.get('Input','json_file')
+    return sorted(glob.glob(home+'/'+indir+'/'+infile))
+
+
+def is_compressed(filename):
+    """
+    Check whether a corpus file is compressed (gzip or xz)
+    """
+    return filename.endswith('.gz') or filename.endswith('.xz')
+
+
+def open_corpus_file(filename):
+    """
+    Open a (possibly compressed) corpus file for reading
+    """
+    if filename.endswith('.gz'):
+        return io.BufferedReader(gzip.open(filename, 'rb'))
+    elif filename.endswith('.xz'):
+        return lzma.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+class FileReader(threading.Thread):
+
+    """
+    Read a corpus file in a background thread
+    Lines are passed on in chunks of roughly chunk_size bytes through
+    a queue that holds at most queue_size chunks
+    """
+
+    def __init__(self, filename, chunk_size, queue_size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(maxsize=queue_size)
+
+
+    def run(self):
+        try:
+            with open_corpus_file(self.filename) as f:
+                chunk = []
+                size = 0
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    chunk.append(line)
+                    size += len(line)
+                    if size >= self.chunk_size:
+                        self.queue.put(chunk)
+                        chunk = []
+                        size = 0
+                if chunk != []:
+                    self.queue.put(chunk)
+            self.queue.put(None)
+        except Exception, ex:
+            self.queue.put(ex)
+
+
+    def chunks(self):
+        """
+        Yield the chunks of lines read from the file, in order
+        """
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise IOError("Cannot read corpus file '%s': %s" % (self.filename, chunk))
+            yield chunk
+
+
+class CorpusReader():
+
+    """
+    Iterate over the lines of a list of corpus files, in chunks,
+    in the order of the files
+    """
+
+    def __init__(self, filenames, chunk_size, prefetch=2, queue_size=4):
+        self.filenames = filenames
+        self.chunk_size = chunk_size
+        self.prefetch = max(1, prefetch)
+        self.queue_size = queue_size
+
+
+    def __iter__(self):
+        files = iter(self.filenames)
+        readers = []
+        def start_reader():
+            filename = next(files, None)
+            if filename is not None:
+                reader = FileReader(filename, self.chunk_size, self.queue_size)
+                reader.start()
+                readers.append(reader)
+        for x in range(0, self.prefetch):
+            start_reader()
+        while readers != []:
+            reader = readers.pop(0)
+            for chunk in reader.chunks():
+                yield chunk
+            start_reader()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate article detection using MinHash signatures and
+locality-sensitive hashing (LSH)
+
+Syndicated news stories appear many times in the corpus under different
+article IDs. Each article is reduced to a MinHash signature over its word
+shingles; articles whose signatures agree on at least one LSH band are
+compared, and an article is a duplicate of an earlier one if the estimated
+Jaccard similarity of their shingle sets reaches the threshold. Only the
+most recent max_articles articles are kept in the index, so memory use
+is bounded.
+"""
+
+# Standard
+import zlib
+import numpy as np
+from collections import OrderedDict
+
+
+# Mersenne prime used for the MinHash permutations
+PRIME = (1 << 31) - 1
+
+# Permutation coefficients, keyed by number of permutations
+_coefficients = {}
+
+
+def get_coefficients(num_perm):
+    """
+    Return the (fixed) coefficients of the hash permutations
+    A fixed seed is used so that signatures computed by different
+    processes (and different runs) are comparable
+    """
+    if num_perm not in _coefficients:
+        rs = np.random.RandomState(1)
+        a = rs.randint(1, PRIME, size=num_perm).astype(np.uint64)
+        b = rs.randint(0, PRIME, size=num_perm).astype(np.uint64)
+        _coefficients[num_perm] = (a.reshape(-1, 1), b.reshape(-1, 1))
+    return _coefficients[num_perm]
+
+
+def minhash_signature(sentences, num_perm, shingle_size):
+    """
+    Compute the MinHash signature of an article (list of sentences)
+    Shingles are sequences of shingle_size (lowercased) words
+    Return a numpy array of num_perm values, or None for an empty article
+    """
+    words = ' '.join(sentences).lower().split()
+    if words == []:
+        return None
+    shingles = set(' '.join(words[i:i+shingle_size])
+                   for i in range(0, max(1, len(words)-shingle_size+1)))
+    hashes = np.array([zlib.crc32(s.encode('utf-8')) & 0xffffffff for s in shingles],
+                      dtype=np.uint64)
+    a, b = get_coefficients(num_perm)
+    return (((a * hashes + b) % PRIME).min(axis=1)).astype(np.uint32)
+
+
+class MinHashDeduplicator():
+
+    """
+    Index of article signatures for near-duplicate detection
+    """
+
+    def __init__(self, bands, threshold, max_articles):
+        self.bands = bands
+        self.threshold = threshold
+        self.max_articles = max_articles
+        # article ID -> (signature, band keys), oldest first
+        self.articles = OrderedDict()
+        # band key -> article ID
+        self.buckets = {}
+
+
+    def band_keys(self, signature):
+        """
+        Split a signature into bands and return a hash key for each band
+        """
+        rows = len(signature) // self.bands
+        return [(band, signature[band*rows:(band+1)*rows].tostring())
+                for band in range(0, self.bands)]
+
+
+    def find_duplicate(self, articleid, signature):
+        """
+        Return the ID of an indexed article of which this article is a near-duplicate
+        If there is none, add the article to the index and return None
+        """
+        if signature is None:
+            return None
+        keys = self.band_keys(signature)
+        candidates = []
+        for key in keys:
+            candidate = self.buckets.get(key)
+            if candidate is not None and candidate not in candidates:
+                candidates.append(candidate)
+        for candidate in candidates:
+            similarity = np.mean(self.articles[candidate][0] == signature)
+            if similarity >= self.threshold:
+                return candidate
+        self.add(articleid, signature, keys)
+        return None
+
+
+    def add(self, articleid, signature, keys):
+        """
+        Add an article to the index, evicting the oldest article if the index is full
+        """
+        if articleid in self.articles:
+            return
+        self.articles[articleid] = (signature, keys)
+        for key in keys:
+            self.buckets[key] = articleid
+        if len(self.articles) > self.max_articles:
+            oldid, (oldsignature, oldkeys) = self.articles.popitem(last=False)
+            for key in oldkeys:
+                if self.buckets.get(key) == oldid:
+                    del self.buckets[key]
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact dependency trees, read from CoNLL-U files
+
+A DependencyTree holds the tokens of a sentence in parallel lists (word,
+lemma, coarse and fine tag, head and relation, indexed by token address),
+with an index of the children of each token, rather than a dictionary per
+token as nltk's DependencyGraph does. Tag and relation strings are interned,
+so that all trees share a single copy of each.
+
+The trees have the accessor surface of DependencyGraph used by the pipeline:
+    * dt.nodes[i]['word'], ['lemma'], ['ctag'], ['tag'], ['head'], ['rel']
+    * dt.nodes[i]['deps'] - the children of token i, by relation
+    * dt.nodes.get(i) - None if there is no token i
+    * iteration over dt.nodes (token addresses, in order) and len(dt.nodes)
+Address 0 is the artificial root node (tags "TOP", no word or head). As with
+DependencyGraph, dt.nodes[i] for an address i outside the sentence is an
+empty node (all values None, no children).
+The nodes are plain dictionaries, so that reading them is as fast as with
+DependencyGraph. Each node is built from the lists the first time its address
+is accessed, and then kept with the tree: only the nodes that are read (e.g.
+the entity tokens and their heads) are held as dictionaries. Code that reads
+every token (e.g. the words or tags of a sentence) should read the lists
+(dt.word, dt.ctag, ...) rather than the nodes.
+"""
+
+# Standard
+import io
+from array import array
+from bisect import bisect_left
+
+
+# Interned tag and relation strings
+_strings = {}
+
+
+def intern_strings(strings):
+    """
+    Return the list of the interned copies of strings
+    """
+    return map(_strings.setdefault, strings, strings)
+
+
+class DependencyTree(object):
+
+    """
+    Dependency tree of a sentence
+    """
+
+    __slots__ = ('word', 'lemma', 'ctag', 'tag', 'head', 'rel', 'child_start', 'children', 'node_dicts')
+
+    def __init__(self, tokens):
+        """
+        tokens is a list of (word, lemma, ctag, tag, head, rel) tuples, for the
+        token addresses 1 to n
+        """
+        words, lemmas, ctags, tags, heads, rels = zip(*tokens)
+        top = intern_strings([u'TOP'])
+        self.word = [None] + list(words)
+        self.lemma = [None] + list(lemmas)
+        self.ctag = top + intern_strings(ctags)
+        self.tag = top + intern_strings(tags)
+        self.head = array('i', (-1,) + heads)
+        self.rel = [None] + intern_strings(rels)
+        # Children index: the children of token i (in address order) are
+        # children[child_start[i]:child_start[i+1]]. Tokens are sorted by head
+        # (a stable sort, so children stay in address order); tokens whose
+        # head is outside the sentence are nobody's children
+        n = len(self.word)
+        order = sorted(range(1, n), key=self.head.__getitem__)
+        self.children = array('i', [i for i in order if 0 <= self.head[i] < n])
+        child_heads = [self.head[i] for i in self.children]
+        self.child_start = array('i', [bisect_left(child_heads, i) for i in range(0, n + 1)])
+        self.node_dicts = None
+
+
+    def __len__(self):
+        return len(self.word)
+
+
+    @property
+    def nodes(self):
+        """
+        Nodes of the tree, by address (each built on first access)
+        """
+        if self.node_dicts is None:
+            self.node_dicts = Nodes(self)
+        return self.node_dicts
+
+
+class Nodes(dict):
+
+    """
+    Nodes of a tree, by address
+    A node is built from the lists of the tree when its address is first
+    accessed; iteration, len and membership cover all the addresses of the
+    tree. The node of an address outside the sentence is an empty node
+    (which, unlike in DependencyGraph, is not added to the tree)
+    """
+
+    # The lists of the tree (not the tree itself, which holds the nodes)
+    __slots__ = ('word', 'lemma', 'ctag', 'tag', 'head', 'rel', 'child_start', 'children')
+
+    def __init__(self, tree):
+        dict.__init__(self)
+        for name in Nodes.__slots__:
+            setattr(self, name, getattr(tree, name))
+
+
+    def __missing__(self, address):
+        """
+        Build the node of an address, with the children of the node by
+        relation (nodes without children share an empty mapping)
+        """
+        if address not in self:
+            return EMPTY_NODE
+        deps = EMPTY_DEPS
+        for c in self.children[self.child_start[address]:self.child_start[address + 1]]:
+            if deps is EMPTY_DEPS:
+                deps = Deps()
+            deps.setdefault(self.rel[c], []).append(c)
+        node = {'address': address, 'word': self.word[address], 'lemma': self.lemma[address],
+                'ctag': self.ctag[address], 'tag': self.tag[address],
+                'head': self.head[address] if address != 0 else None, 'deps': deps, 'rel': self.rel[address]}
+        self[address] = node
+        return node
+
+
+    def __contains__(self, address):
+        return isinstance(address, (int, long)) and 0 <= address < len(self.word)
+
+
+    def __iter__(self):
+        return iter(xrange(len(self.word)))
+
+
+    def __len__(self):
+        return len(self.word)
+
+
+    def keys(self):
+        return list(self)
+
+
+    def get(self, address, default=None):
+        return self[address] if address in self else default
+
+
+class Deps(dict):
+
+    """
+    Children of a node, by relation
+    As with the defaultdict of DependencyGraph, a relation without children
+    gives an empty list (which, unlike in DependencyGraph, is not added)
+    """
+
+    __slots__ = ()
+
+    def __missing__(self, rel):
+        return []
+
+
+EMPTY_DEPS = Deps()
+
+# Node returned for addresses outside the sentence
+EMPTY_NODE = {'address': None, 'word': None, 'lemma': None, 'ctag': None, 'tag': None,
+              'head': None, 'deps': EMPTY_DEPS, 'rel': None}
+
+
+def read_dependency_trees(filename):
+    """
+    Read a CoNLL-U file (e.g. dependency parser output) into a list of trees,
+    one per sentence
+    Comments, multi-word tokens and empty nodes are skipped, and the
+    relation "root" is renamed "ROOT" (as DependencyGraph expects)
+    """
+    trees = []
+    tokens = []
+    with io.open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line[0] == '#':
+                continue
+            line = line.rstrip()
+            if line == '':
+                if tokens != []:
+                    trees.append(DependencyTree(tokens))
+                    tokens = []
+                continue
+            cells = line.split('\t')
+            if cells[6] == '_':
+                continue
+            if int(cells[0]) != len(tokens) + 1:
+                raise ValueError("%s: token '%s' out of sequence" % (filename, cells[0]))
+            rel = u'ROOT' if cells[7] == u'root' else cells[7]
+            tokens.append((cells[1], cells[2], cells[3], cells[4], int(cells[6]), rel))
+    if tokens != []:
+        trees.append(DependencyTree(tokens))
+    return trees
@@ -2,52 +2,126 @@
 # -*- coding: utf-8 -*-
 
 # Standard
+import os
 import codecs
+import heapq
 import collections
 import simplejson as json
-from nltk.parse import DependencyGraph
+
+# Custom
+import dependency_tree
 
 
 def dependency_parse_to_graph(filename):
     """
     Read dependency parser output from file and construct graph
+    Return a list of dependency trees (dependency_tree.DependencyTree), one per sentence
     """
-    data = ''
-    dtree = []
-    with open(filename, 'r') as f:
-        for line in f:
-            if line[0] != '#':
-                if 'root' in line:
-                    elements = line.split('\t')
-                    if elements[7] == 'root':
-                        elements[7] = 'ROOT'
-                        line = '\t'.join(elements)
-                data += line
-                if line == '\n':
-                    dg = DependencyGraph(data.decode('utf8'))
-                    dtree.append(dg)
-                    data = ''
-    return dtree
+    return dependency_tree.read_dependency_trees(filename)
+
+
+def read_conllu_blocks(f):
+    """
+    Read a CoNLL-U file one sentence at a time
+    Yield the lines of each sentence (including comments and the
+    terminating empty line) as a single string
+    """
+    block = []
+    for line in f:
+        block.append(line)
+        if line.strip() == '':
+            if len(block) > 1:
+                yield ''.join(block)
+            block = []
+    if block != [] and ''.join(block).strip() != '':
+        yield ''.join(block)
 
 
 def extract_entities_from_dependency_parse(dtrees, postag):
     """
     Extract all tokens / multi-token spans from a dependency parse
+    The tokens are read from the word and tag lists of the trees (address 0
+    is the root), without building their nodes
     """
     sents = []
-    for x in range(0,len(dtrees)):
+    for dt in dtrees:
         tok_list = []
-        for node_index in dtrees[x].nodes:
-            if node_index != 0:
-                node = dtrees[x].nodes[node_index]
-                if node['ctag'] == postag:
-                    tok_list.append((node['word'],postag))
-                else:
-                    tok_list.append((node['word'],'O'))
+        for word, ctag in zip(dt.word[1:], dt.ctag[1:]):
+            if ctag == postag:
+                tok_list.append((word,postag))
+            else:
+                tok_list.append((word,'O'))
         sents.append(tok_list)
     return sents
 
 
+def get_config_value(config, section, option, default):
+    """
+    Read an optional setting from the config file
+    Return the default if the setting is absent. The type of the default
+    determines how the setting is parsed (bool, int, float or string)
+    """
+    if not config.has_option(section, option):
+        return default
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+    if isinstance(default, int):
+        return config.getint(section, option)
+    if isinstance(default, float):
+        return config.getfloat(section, option)
+    return config.get(section, option)
+
+
+def external_parser_selected(config):
+    """
+    Check whether the dependency parse is produced by a parser other than
+    UDPipe (specified in config as "backend" in the "Parser" section)
+    """
+    return get_config_value(config, 'Parser', 'backend', 'unstable') != 'udpipe'
+
+
+def split_file_into_line_ranges(filename, chunk_size):
+    """
+    Split a file into byte ranges of roughly chunk_size bytes
+    Each range starts at the beginning of a line and ends just after a newline
+    (or at the end of the file), so no line is split across two ranges
+    """
+    ranges = []
+    filesize = os.path.getsize(filename)
+    start = 0
+    with open(filename, 'rb') as f:
+        while start < filesize:
+            end = start + chunk_size
+            if end >= filesize:
+                end = filesize
+            else:
+                # Move the end of the range forward to the next line boundary
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def bounded_imap(pool, func, iterable, max_pending):
+    """
+    Apply func to each item of iterable using the pool, yielding results in order
+    No more than max_pending items are submitted before their results have
+    been consumed, so memory use is bounded for long (streamed) inputs
+    Items are submitted by the consumer (not by the pool's task handler
+    thread), so if the consumer stops early nothing is left waiting, and the
+    pool can be terminated
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 def read_json(filename):
     """
     Read a json file to a json object
@@ -94,19 +168,40 @@ def write_nested_string_list_to_file(string_list, filename):
 def group_batches_for_parallel_processing(batchnamesfile, batchgroupsfile, cores):
     """
     Split batch files into groups, one group per available core
+    Groups are balanced by the estimated size of each batch (second column of
+    the batch names file) using longest-processing-time-first assignment:
+    the largest remaining batch goes to the group with the smallest total size.
+    Batches without an estimated size count as size 1.
     """
-    l = [[] for i in range(cores)]
-    counter = 0
+    batches = []
     with open(batchnamesfile) as f:
         for line in f:
-            counter += 1
-            filename = line.rstrip('\n')
-            group = counter % cores
-            l[group].append(filename)
-    write_nested_string_list_to_file(l, batchgroupsfile)
+            elements = line.rstrip('\n').split('\t')
+            size = int(elements[1]) if len(elements) > 1 else 1
+            batches.append((elements[0], size))
+    l = [[] for i in range(cores)]
+    sizes = {}
+    loads = [(0, group) for group in range(cores)]
+    for filename, size in sorted(batches, key=lambda b: -b[1]):
+        load, group = heapq.heappop(loads)
+        l[group].append(filename)
+        sizes[filename] = size
+        heapq.heappush(loads, (load + size, group))
+    write_batch_groups_to_file(l, sizes, batchgroupsfile)
     return l
 
 
+def write_batch_groups_to_file(groups, sizes, filename):
+    """
+    Write batch groups to file, one batch per line
+    Format of line: batch name, index of group, estimated size of batch
+    """
+    with open(filename, 'w') as f:
+        for i in range(0,len(groups)):
+            for element in groups[i]:
+                f.write(element+'\t'+str(i)+'\t'+str(sizes[element])+'\n')
+
+
 def create_files(filename_list, encoding):
     """
     Create empty files given specific a list of one or more specififed names
@@ -133,3 +228,20 @@ def read_group_batches(filename):
     except IOError as e:
         print(e)
     return l
+
+
+def read_batch_sizes(filename):
+    """
+    Read batch groups file and return a dictionary mapping each batch
+    to its estimated size (if recorded)
+    """
+    d = {}
+    try:
+        with open(filename) as f:
+            for line in f:
+                elements = line.rstrip('\n').split('\t')
+                if len(elements) > 2:
+                    d[elements[0]] = int(elements[2])
+    except IOError as e:
+        print(e)
+    return d
@@ -21,14 +21,15 @@ Liane Guillou, The University of Edinburgh, April 2018
 """
 
 # Standard
+import os
 import sys
+import time
 import glob
 import logging
 import ConfigParser
 import traceback
 import multiprocessing as mp
 from datetime import datetime
-from functools import partial
 from itertools import chain
 
 # Custom
@@ -37,6 +38,7 @@ import helper_functions as hf
 import ner
 import nel
 import binary_relation
+import parser_service
 
 
 def get_config(configfile):
@@ -61,19 +63,106 @@ def compute_cores(config):
     return cores
 
 
-def process_batch_group(batch_name_list, instance_to_create):
+# Pipeline step instances used by this worker process (set by init_worker)
+worker_steps = []
+# Time this worker process spent loading resources, until it is reported
+worker_startup = 0.0
+# Traceback of the error raised while loading this worker's resources, if any
+worker_error = None
+
+
+def load_resources(steps):
+    """
+    Load the resources (models, type maps, HTTP sessions) used by the pipeline
+    steps in the main process, before the pool of workers is created
+    A missing model or mapping file, or an unreachable service, stops the
+    pipeline here: the pool would otherwise restart a worker whose initialiser
+    fails indefinitely. The workers inherit the loaded resources
+    """
+    for step in steps:
+        try:
+            step.load_resources()
+        except Exception:
+            message = "ERROR: Cannot load the resources of step %s\n%s" % (step.__class__.__name__,
+                                                                            traceback.format_exc())
+            logging.error(message+'  Exited at: '+str(datetime.now())+'\n\n')
+            sys.stderr.write(message)
+            sys.exit(1)
+    # The main process does not parse: close its connection to the parser
+    # service (which would otherwise wait for its requests), so that the
+    # workers do not inherit it
+    parser_service.close_clients()
+
+
+def init_worker(instances_to_create):
+    """
+    Pool initialiser: keep the pipeline step instances for the lifetime of the
+    worker, and load the resources (models, type maps, HTTP sessions) that
+    they use, so that these are loaded once per worker and reused across
+    all batches and steps
+    An error is not raised here (the pool would restart the worker
+    indefinitely) but by process_batch, so that the step fails
+    """
+    global worker_steps, worker_startup, worker_error
+    start = time.time()
+    worker_steps = instances_to_create
+    try:
+        for step in worker_steps:
+            step.load_resources()
+    except (Exception, SystemExit):
+        worker_error = traceback.format_exc()
+    worker_startup = time.time() - start
+
+
+def process_batch(task):
     """
-    Create an instance of the relevant pipeline step object
-    and call its main method (called "process" for each step)
+    Call the main method of one of the worker's pipeline step objects
+    (called "process" for each step) for a single batch
+    Return the worker's process ID, the processing time, and the time spent
+    loading resources (reported with the first batch the worker processes)
     """
+    global worker_startup
     try:
-        proc_inst = instance_to_create
-        proc_inst.process(batch_name_list)
+        if worker_error is not None:
+            raise RuntimeError('Worker %d could not load resources:\n%s' % (os.getpid(), worker_error))
+        step_index, batch_name = task
+        start = time.time()
+        worker_steps[step_index].process([batch_name])
+        elapsed = time.time() - start
+        startup = worker_startup
+        worker_startup = 0.0
+        return (os.getpid(), elapsed, startup)
     except Exception, ex:
         print traceback.format_exc()
         raise ex
 
 
+def run_parallel_step(pool, step_index, step, batch_list):
+    """
+    Run a pipeline step over all batches using the pool of workers
+    Each batch is submitted as a separate task, so idle workers pick up the
+    next batch as soon as they finish. At the end of the step, log the
+    utilisation (share of the step's wall-clock time spent processing) of
+    each worker, and any time spent loading resources
+    """
+    stepname = step.__class__.__name__
+    logging.info('started step '+stepname+': '+str(datetime.now()))
+    start = time.time()
+    busy = {}
+    counts = {}
+    tasks = [(step_index, batch) for batch in batch_list]
+    for pid, elapsed, startup in pool.imap_unordered(process_batch, tasks, chunksize=1):
+        busy[pid] = busy.get(pid, 0.0) + elapsed
+        counts[pid] = counts.get(pid, 0) + 1
+        if startup > 0:
+            logging.info('  worker %d: startup (loading resources) %.1fs' % (pid, startup))
+    walltime = time.time() - start
+    logging.info('finished step '+stepname+' in %.1fs' % walltime)
+    for pid in sorted(busy):
+        logging.info('  worker %d: %d batches, busy %.1fs (%.1f%% utilisation)' %
+                     (pid, counts[pid], busy[pid], 100.0 * busy[pid] / max(walltime, 1e-9)))
+
+
 def get_pipeline_steps(config):
     """
     Determine whether the full pipeline / a section of it is to be run
@@ -93,9 +182,11 @@ def get_pipeline_steps(config):
     batching = True if start_step == 1 else False
     rel_extraction = True if end_step == 6 else False
     #nel = True if start_step<=4 and end_step>4 else False
-    # Parallel pipeline steps, removed parsing.UnstParser(configmap) from list, 
-    parallel_step_list = [pre.Preprocessor(configmap), ner.Ner(configmap),nel.Nel(configmap)]
-    parallel_steps = parallel_step_list[max(0,start_step-2):end_step-1]
+    # Parallel pipeline steps (parsing is done by a single parser service, to which the workers send their batches)
+    # With the udpipe parser backend, the UDPipe parse is used and the parsing step is skipped
+    parser_step = parsing.UnstParser(configmap) if hf.external_parser_selected(configmap) else None
+    parallel_step_list = [pre.Preprocessor(configmap), ner.Ner(configmap), parser_step, nel.Nel(configmap)]
+    parallel_steps = [s for s in parallel_step_list[max(0,start_step-2):end_step-1] if s is not None]
     return parallel_steps, batching, rel_extraction
 
 
@@ -115,7 +206,7 @@ if __name__ == "__main__":
     # The untable parser uses the namespace "parser" which is the same
     # name as a standard python library. To get around this problem
     # add the unstable parser path to sys.path before importing the
-    # "parsing.py" module
+    # "parsing.py" module (the parser itself is imported by the parser service)
     unstableparserpath = configmap.get('UnstableParser','path')
     sys.path.insert(0,unstableparserpath)
     import parsing
@@ -129,40 +220,41 @@ if __name__ == "__main__":
     # Batching and sentence segmentation
     homedir = configmap.get('General','home')
     batchgroupsfile = homedir + '/' + configmap.get('General','batch_groups_file') 
-    logging.info('started batching: '+str(datetime.now()))
-    if batching:
-        preprocessor = pre.Preprocessor(configmap)
-        preprocessor.batch_and_segment()
-        # Split batches into groups according to number of cores available for paralellisation
-        batchnamesfile = homedir + '/' + configmap.get('General','batches_file')
-        batch_groups_list = hf.group_batches_for_parallel_processing(batchnamesfile, batchgroupsfile, cores)
-    else:
-        # Read batch groups from file
-        batch_groups_list = hf.read_group_batches(batchgroupsfile)
-        print(batch_groups_list)
-    # Implement pipeline steps for which parallelisation makes sense
-    for step in parallel_steps:
-        # Set up a pool of workers
-        pool = mp.Pool(processes=cores)
-        process_batch_group_with_instance=partial(process_batch_group, instance_to_create=step)
-        pool.map(process_batch_group_with_instance, batch_groups_list)
-        pool.close()
-        pool.join()
-        pool.terminate()
-    # Try and do nel with 5 threads only
-    """
-    if nel:
-        batch_list = list(chain(*batch_groups_list))
-        nell=nel.Nel(configmap)
-        #nel.process(batch_list)
-        newChunks = [batch_list[i::5] for i in xrange(5)]
-        pool = mp.Pool(processes=cores)
-        process_batch_group_with_instance=partial(process_batch_group, instance_to_create=nell)
-        pool.map(process_batch_group_with_instance, newChunks)
-        pool.close()
-        pool.join()
+    # Start the parser service (which loads the parser model once, for all workers)
+    service = None
+    if any(isinstance(step, parsing.UnstParser) for step in parallel_steps):
+        service = parser_service.ParserService(configmap)
+        service.start()
+    # Load the resources of the parallel steps (exits if any cannot be loaded)
+    load_resources(parallel_steps)
+    # Set up a pool of workers, used for batching and all parallel steps
+    pool = mp.Pool(processes=cores, initializer=init_worker, initargs=(parallel_steps,))
+    try:
+        logging.info('started batching: '+str(datetime.now()))
+        if batching:
+            preprocessor = pre.Preprocessor(configmap)
+            preprocessor.batch_and_segment(cores, pool)
+            # Split batches into groups according to number of cores available for paralellisation
+            batchnamesfile = homedir + '/' + configmap.get('General','batches_file')
+            batch_groups_list = hf.group_batches_for_parallel_processing(batchnamesfile, batchgroupsfile, cores)
+        else:
+            # Read batch groups from file
+            batch_groups_list = hf.read_group_batches(batchgroupsfile)
+            print(batch_groups_list)
+        # Implement pipeline steps for which parallelisation makes sense
+        # Batches are scheduled largest first (by estimated size), so that
+        # small batches fill in the gaps at the end of each step
+        batch_sizes = hf.read_batch_sizes(batchgroupsfile)
+        schedule = sorted(chain(*batch_groups_list), key=lambda b: -batch_sizes.get(b, 1))
+        for step_index in range(0,len(parallel_steps)):
+            run_parallel_step(pool, step_index, parallel_steps[step_index], schedule)
+    except:
         pool.terminate()
-    """
+        raise
+    pool.close()
+    pool.join()
+    if service is not None:
+        service.stop()
     # Extract binary relations in series (I/O bound, will not benefit from parallelisation)
     if rel_extraction:
         batch_list = list(chain(*batch_groups_list))
@@ -12,9 +12,14 @@ import logging
 import subprocess
 import simplejson as json
 from itertools import izip
+from itertools import product
+from multiprocessing.pool import ThreadPool
 
 # Custom
 import helper_functions as hf
+import resources as res
+import cache
+import binary_relation as br
 from agdistis import Agdistis
 from datetime import datetime
 
@@ -31,6 +36,14 @@ class Nel():
         self.home = self.config.get('General', 'home')
         
 
+    def load_resources(self):
+        """
+        Load the resources used by this step (called once per worker process)
+        """
+        self.get_dbpedia_to_figer_mapping()
+        res.get_http_session(hf.get_config_value(self.config, 'Agdistis', 'concurrency', 1))
+
+
     def process(self, files):
         """
         Main method
@@ -65,27 +78,81 @@ class Nel():
                     f.write('\n')
             
 
-    def format_nel_sentences(self, nerfile, entfile):
+    def format_nel_sentences(self, nerfile, entfile, dtrees=None, counts=None):
         """
         Format sentence string for input to AGDISTIS
         Add <entity></entity> tags around each entity
+        If the dependency trees of the sentences are given, only the entities
+        that can be an argument of a binary relation are tagged (and the number
+        of sentences and entities before and after filtering added to counts)
+        Return the formatted sentences, the entity mappings and the formatted
+        sentences before filtering
         """
         sentences = []
         ent_map = {}
+        unfiltered = []
         ner_sents = self.get_entities_from_file(nerfile, 'ner')
         ent_sents = self.get_entities_from_file(entfile, 'com')
+        if dtrees is not None and len(dtrees) != len(ner_sents):
+            logging.warning('dependency parse of '+nerfile.split('/')[-1]+' does not match the NER output, '
+                            'not filtering relation candidates')
+            dtrees = None
         for x in range(0,len(ner_sents)):
             entity = 0 if (ner_sents[x][1] == 0 and ent_sents[x][1] == 0) else 1
             ner_tagged = ner_sents[x][2]
             ent_tagged = ent_sents[x][2]
             # Detect overlaps and merge NEs and common entities
             tagged = self.merge_entities(ner_tagged, ent_tagged)
+            unfiltered.append(self.add_entity_tags(tagged))
+            if dtrees is not None and entity:
+                tagged = self.filter_relation_candidates(tagged, dtrees[x], counts)
             # Output a formatted sentence
             formatted_sent = self.add_entity_tags(tagged)
             sentences.append((x,entity,formatted_sent))
             # Create a mapping so that NEs and common entities can be identified later
             ent_map[x] = self.create_map_entities(tagged)
-        return (sentences, ent_map)
+        return (sentences, ent_map, unfiltered)
+
+
+    def filter_relation_candidates(self, tagged, dt, counts):
+        """
+        Untag the entities that cannot be an argument of a binary relation: an
+        entity is kept only if it forms a candidate pair (see
+        binary_relation.is_candidate_pair) with another entity of the sentence,
+        at least one of the two being a named entity
+        """
+        ent_map = self.create_map_entities(tagged)
+        counts['sentences'] += 1
+        counts['entities'] += len(ent_map)
+        if len(tagged) != len(dt.nodes) - 1:
+            # Tokens do not match the parse: keep all entities
+            counts['sentences_kept'] += 1
+            counts['entities_kept'] += len(ent_map)
+            return tagged
+        candidates = set()
+        for start1, start2 in product(ent_map.keys(), repeat=2):
+            if start1 == start2 or (ent_map[start1][1][0:3] == 'com' and ent_map[start2][1][0:3] == 'com'):
+                continue
+            if br.is_candidate_pair(dt, start1, start2):
+                candidates.add(start1)
+                candidates.add(start2)
+        if candidates != set():
+            counts['sentences_kept'] += 1
+            counts['entities_kept'] += len(candidates)
+        # Tokens belong to the entity starting at the last change of tag (see create_map_entities)
+        filtered = []
+        start = None
+        for t in range(0,len(tagged)):
+            tag = tagged[t][1]
+            if tag == '0':
+                start = None
+            elif t == 0 or tag != tagged[t-1][1]:
+                start = t+1
+            if start is not None and start not in candidates:
+                filtered.append((tagged[t][0], '0'))
+            else:
+                filtered.append(tagged[t])
+        return filtered
 
 
     def create_map_entities(self, tagged):
@@ -212,11 +279,10 @@ class Nel():
         """
         Get DBPedia to FIGER mapping
         Use the mapping file that maps DBPedia->Freebase->FIGER
+        The mapping is loaded once per process and reused for all subsequent batches
         """
         mapfile = self.config.get('TypeMapping','map_file')
-        with gzip.open(mapfile, 'r') as mfile:
-            m = json.load(mfile)
-        return m
+        return res.get_type_map(mapfile)
 
     
     def convert_offsets(self,sentence):
@@ -243,38 +309,234 @@ class Nel():
         url = self.config.get('Agdistis','url')
         nerfiles = sorted([self.home+'/'+nerindir+'/'+f for f in files])
         entfiles = sorted([self.home+'/'+entindir+'/'+f for f in files])
-        ag = Agdistis(url)
+        # Up to concurrency requests are sent at a time, over a pool of kept-alive connections
+        # (fewer while the server is slow to respond or failing)
+        concurrency = hf.get_config_value(self.config, 'Agdistis', 'concurrency', 1)
+        limiter = res.get_limiter(self.config, 'Agdistis', 'AGDISTIS', concurrency)
+        ag = Agdistis(url, res.get_http_session(concurrency), limiter)
+        pool = ThreadPool(concurrency) if concurrency > 1 else None
+        sentence_cache = cache.get_sentence_cache(self.config, 'nel')
+        entity_cache = cache.get_entity_cache(self.config)
+        # Send one request per sentence, or per article (in chunks of at most max_chars characters)
+        mode = hf.get_config_value(self.config, 'Agdistis', 'mode', 'sentence')
+        max_chars = hf.get_config_value(self.config, 'Agdistis', 'max_chars', 5000)
+        # Only link the entities that can be an argument of a binary relation
+        relation_filter = hf.get_config_value(self.config, 'Agdistis', 'relation_filter', False)
+        parseindir = self.config.get('UnstableParser','post_proc_out_dir')
+        counts = {'sentences': 0, 'sentences_kept': 0, 'entities': 0, 'entities_kept': 0, 'requests_avoided': 0}
+        # Sentences left unlinked because their request failed after retries
+        failed = []
         # Get DBPedia to FIGER mapping
         type_map = self.get_dbpedia_to_figer_mapping()
         for x in range(0,len(nerfiles)):
             nf = nerfiles[x]
             ef = entfiles[x]
             # Read file and format sentences
-            temp = self.format_nel_sentences(nf, ef)
+            dtrees = None
+            if relation_filter:
+                dtrees = hf.dependency_parse_to_graph(self.home+'/'+parseindir+'/'+nf.split('/')[-1])
+            temp = self.format_nel_sentences(nf, ef, dtrees, counts)
             formatted = temp[0]
             ent_map = temp[1]
             nel = {"file": nf.split('/')[-1], "sentences": {}}
             formatted_sents = [sent[2] for sent in formatted]
-            text = '\n'.join(formatted_sents).decode('utf-8')
-            for sent in range(0,len(formatted_sents)):
-                if '<entity>' in formatted_sents[sent]:
-                    disambig = ag.disambiguate(formatted_sents[sent])
+            # Link the sentences whose entities are all in the entity cache without a request
+            linked = {}
+            if entity_cache:
+                for sent in range(0,len(formatted_sents)):
+                    if '<entity>' in formatted_sents[sent]:
+                        entities = entity_cache.link(formatted_sents[sent])
+                        if entities is not None:
+                            linked[sent] = entities
+            # Disambiguate the other sentences containing entities
+            articles = None
+            if mode == 'document':
+                articles = self.get_sentence_articles(nf.split('/')[-1], len(formatted_sents))
+            if articles is not None:
+                disambiguated = self.disambiguate_documents(ag, pool, formatted_sents, articles, max_chars, linked,
+                                                            failed)
+            else:
+                disambiguated = self.disambiguate_sentences(ag, pool, formatted_sents, sentence_cache, linked,
+                                                            failed)
+            if entity_cache:
+                for sent in disambiguated:
+                    entity_cache.add(formatted_sents[sent], disambiguated[sent])
+            disambiguated.update(linked)
+            if relation_filter:
+                # Sentences whose entities were all removed by the filter are output without entities
+                filtered_out = [sent for (sent, entity, s) in formatted if entity and '<entity>' not in s]
+                for sent in filtered_out:
+                    disambiguated[sent] = []
+                counts['requests_avoided'] += self.count_requests_avoided(temp[2], formatted_sents, filtered_out,
+                                                                          articles, max_chars, linked)
+            for sent in sorted(disambiguated):
+                disambig = disambiguated[sent]
                 # For each sentence, map entities to Freebase, convert to dictionary
-                    converted = self.map_and_convert_nel(sent, formatted_sents[sent], disambig, type_map, ent_map[sent])
-                    nel["sentences"][sent] = converted
+                converted = self.map_and_convert_nel(sent, formatted_sents[sent], disambig, type_map, ent_map[sent])
+                nel["sentences"][sent] = converted
             # Write to file
             outfilename = self.home + '/' + outdir + '/' + nf.split('/')[-1]
             with io.open(outfilename, 'w', encoding='utf8') as outfile:
                 data = json.dumps(nel, ensure_ascii=False)
                 outfile.write(unicode(data))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        ag.log_stats()
+        if failed != []:
+            logging.warning('AGDISTIS: %d sentences not linked (requests failed after retries), '
+                            'left out of the NEL output' % len(failed))
+        if relation_filter:
+            self.log_relation_filter(counts, ag, mode)
+        if sentence_cache:
+            sentence_cache.close()
+        if entity_cache:
+            entity_cache.close()
 
                 
+    def log_relation_filter(self, counts, ag, mode):
+        """
+        Log the sentences and entities removed by the relation candidate filter,
+        and the requests (and time, at the measured request throughput) saved by it
+        """
+        logging.info('relation filter: %d of %d sentences and %d of %d entities sent for linking' %
+                     (counts['sentences_kept'], counts['sentences'], counts['entities_kept'], counts['entities']))
+        seconds_per_request = ag.elapsed / max(len(ag.latencies), 1)
+        logging.info('relation filter: %d AGDISTIS requests avoided (%s mode), about %.1f s' %
+                     (counts['requests_avoided'], mode, counts['requests_avoided'] * seconds_per_request))
+
+
+    def count_requests_avoided(self, unfiltered_sents, formatted_sents, filtered_out, articles, max_chars, linked):
+        """
+        Count the AGDISTIS requests avoided by the relation candidate filter in a
+        batch: the sentences whose entities were all removed in sentence mode, or
+        in document mode the chunks sent without the filter minus those sent with it
+        """
+        if articles is None:
+            return len(filtered_out)
+        unfiltered = [sent for sent in range(0,len(unfiltered_sents))
+                      if '<entity>' in unfiltered_sents[sent] and sent not in linked]
+        filtered = [sent for sent in range(0,len(formatted_sents))
+                    if '<entity>' in formatted_sents[sent] and sent not in linked]
+        return (len(self.make_chunks(unfiltered, unfiltered_sents, articles, max_chars)) -
+                len(self.make_chunks(filtered, formatted_sents, articles, max_chars)))
+
+
+    def disambiguate_sentences(self, ag, pool, formatted_sents, sentence_cache, linked, failed):
+        """
+        Disambiguate the entities of each sentence in a separate request
+        (unless the sentence is in the sentence cache), skipping the sentences
+        already linked
+        A sentence whose request fails after retries is left unlinked (and
+        added to failed), so that one failing sentence does not stop the step
+        Return a dictionary: sentence number -> disambiguated entities
+        """
+        disambiguated = {}
+        for sent in range(0,len(formatted_sents)):
+            if sent in linked:
+                continue
+            if '<entity>' in formatted_sents[sent] and sentence_cache:
+                cached = sentence_cache.get(formatted_sents[sent])
+                if cached is not None:
+                    disambiguated[sent] = cached
+        to_send = [sent for sent in range(0,len(formatted_sents))
+                   if '<entity>' in formatted_sents[sent] and sent not in disambiguated and sent not in linked]
+        results = ag.disambiguate_all([formatted_sents[sent] for sent in to_send], pool, skip_failures=True)
+        for sent, disambig in izip(to_send, results):
+            if disambig is None:
+                failed.append(sent)
+                continue
+            disambiguated[sent] = disambig
+            if sentence_cache:
+                sentence_cache.put(formatted_sents[sent], disambig)
+        return disambiguated
+
+
+    def get_sentence_articles(self, filename, num_sents):
+        """
+        Read the article number of each sentence of a batch from the batch mapping
+        file written by the preprocessor, or return None if it does not match the batch
+        """
+        indir = self.config.get('Preprocessor','out_dir')
+        mapfile = self.home + '/' + indir + '/' + filename + '.lines'
+        try:
+            with open(mapfile) as f:
+                articles = [line.strip() for line in f if line.strip() != '']
+        except IOError:
+            articles = []
+        if len(articles) != num_sents:
+            logging.warning('cannot map the sentences of '+filename+' to articles, disambiguating sentence by sentence')
+            return None
+        return articles
+
+
+    def disambiguate_documents(self, ag, pool, formatted_sents, articles, max_chars, linked, failed):
+        """
+        Disambiguate the entities of each article in a single request: the
+        sentences of an article that contain entities (and are not already
+        linked) are sent together, in chunks of at most max_chars characters
+        The character offsets of the entities are mapped back to sentences
+        The sentences of a chunk whose request fails after retries are left
+        unlinked (and added to failed)
+        Return a dictionary: sentence number -> disambiguated entities
+        """
+        sents = [sent for sent in range(0,len(formatted_sents))
+                 if '<entity>' in formatted_sents[sent] and sent not in linked]
+        chunks = self.make_chunks(sents, formatted_sents, articles, max_chars)
+        results = ag.disambiguate_all(['\n'.join(formatted_sents[sent] for sent in chunk) for chunk in chunks], pool,
+                                      skip_failures=True)
+        disambiguated = {}
+        for chunk, disambig in izip(chunks, results):
+            if disambig is None:
+                failed += chunk
+                continue
+            # Map character offsets in the chunk (without entity tags) to sentences
+            char_map = {}
+            sent_start = {}
+            position = 0
+            for sent in chunk:
+                clean_sent = formatted_sents[sent].replace('<entity>','').replace('</entity>','').decode('utf-8')
+                sent_start[sent] = position
+                for c in range(position, position+len(clean_sent)):
+                    char_map[c] = sent
+                position += len(clean_sent) + 1
+                disambiguated[sent] = []
+            for sent, ents in self.disambiguated_entities_to_sent_number(disambig, char_map).iteritems():
+                # Make the offsets relative to the sentence
+                for ent in ents:
+                    ent["start"] -= sent_start[sent]
+                disambiguated[sent] += ents
+        return disambiguated
+
+
+    def make_chunks(self, sents, formatted_sents, articles, max_chars):
+        """
+        Group sentences (numbers, in order) into the chunks sent to AGDISTIS in
+        document mode: consecutive sentences of the same article, of at most
+        max_chars characters
+        """
+        chunks = []
+        chunk_chars = 0
+        for sent in sents:
+            length = len(formatted_sents[sent]) + 1
+            if chunks != [] and articles[chunks[-1][-1]] == articles[sent] and chunk_chars + length <= max_chars:
+                chunks[-1].append(sent)
+                chunk_chars += length
+            else:
+                chunks.append([sent])
+                chunk_chars = length
+        return chunks
+
+
     def disambiguated_entities_to_sent_number(self, disambig, char_map):
         """
         Map each disambiguated entity to its sentence
         """
         d = {}
         for ent in disambig:
+            if ent["start"] not in char_map:
+                logging.warning('cannot map entity at character '+str(ent["start"])+' to a sentence')
+                continue
             sent = char_map[ent["start"]]
             if sent in d:
                 d[sent].append(ent)
@@ -11,12 +11,17 @@ import ConfigParser
 import logging
 import subprocess
 import simplejson as json
-import sner
 #from nltk.tag import StanfordNERTagger
 #from nltk.internals import config_java
 from itertools import izip
 from datetime import datetime
 
+# Custom
+import cache
+import resources as res
+import ner_client
+import helper_functions as hf
+
 
 class Ner():
 
@@ -33,6 +38,14 @@ class Ner():
 #        config_java(options='-xmx2G')
 
         
+    def load_resources(self):
+        """
+        Load the resources used by this step (called once per worker process)
+        The NER server client holds no state, so there is nothing to load
+        """
+        pass
+
+
     def process(self, files):
         """
         Main method
@@ -41,7 +54,9 @@ class Ner():
         print('process: NER')
         logging.info('started NER: '+str(datetime.now()))
         # Format file with one token per line (take tokenisation from UDPipe)
-        self.pre_process_ner(files)
+        # Only needed for debugging: the tokens are read from the UDPipe output by StanfordNER
+        if hf.get_config_value(self.config, 'NER', 'write_pre_proc', False):
+            self.pre_process_ner(files)
         # Apply NER using GermaNER - not currently used but could be an alternative
         # GermaNER(configmap)
         # Apply NER using Stanford NER - currently in use
@@ -71,23 +86,20 @@ class Ner():
     def extract_sentences(self, filename):
         """
         Extract (word tokenised) sentences from UDPipe output
+        Yield each sentence as a list of tokens
         """
-        with open(filename,'r') as f:
-            tokens = []
-            skip_toks = []
-            sentences = []
-            with open(filename, 'r') as f:
-                for line in f:
-                    if line[0] != '#':
-                        if line == '\n':
-                            if tokens != []: # In case of multiple empty lines
-                                sentences.append(tokens)
-                            tokens = []
-                        else:
-                            elements = line.split('\t')
-                            if '-' not in elements[0]:
-                                tokens.append(elements[1])
-            return sentences
+        tokens = []
+        with open(filename, 'r') as f:
+            for line in f:
+                if line[0] != '#':
+                    if line == '\n':
+                        if tokens != []: # In case of multiple empty lines
+                            yield tokens
+                        tokens = []
+                    else:
+                        elements = line.split('\t')
+                        if '-' not in elements[0]:
+                            tokens.append(elements[1])
     
                         
 #    def GermaNER(self, files):
@@ -109,35 +121,39 @@ class Ner():
         """
         Perform NER using Stanford NER 
         """
-        # Get NER server hostname
-        ner_host = self.config.get('StanfordNER','host_name')
+        # Get NER server endpoints
+        endpoints = ner_client.get_endpoints(self.config)
         # Get input and output directories, and input files
-        indir = self.config.get('NER','pre_proc_out_dir')
+        indir = self.config.get('UDPipe','out_dir')
         outdir = self.config.get('NER','out_dir')
-        # Initialise NER server
-        st = sner.Ner(host=ner_host,port=9199)
+        # Initialise NER server client (batch_size sentences are tagged per request,
+        # with up to concurrency requests in flight, by default one per endpoint)
+        batch_size = hf.get_config_value(self.config, 'StanfordNER', 'batch_size', 1)
+        concurrency = hf.get_config_value(self.config, 'StanfordNER', 'concurrency', len(endpoints))
+        limiter = res.get_limiter(self.config, 'StanfordNER', 'NER', concurrency)
+        st = ner_client.NerClient(endpoints, batch_size, concurrency, limiter)
+        sentence_cache = cache.get_sentence_cache(self.config, 'ner')
         for f in files:
             fpath = self.home + '/' + indir + '/' + f
-            raw_sentences = []
-            tagged_sentences = []
-            # Read tokenised raw sentences
-            with open(fpath, 'r') as infile:
-                tokens = []
-                for line in infile:
-                    if line == '\n':
-                        raw_sentences.append(tokens)
-                        tokens = []
-                    else:
-                        tokens.append(line.rstrip('\n'))
-            # Tag sentences
-            for sent in raw_sentences:
-                s = ' '.join(sent)
-                tagged_sent = st.tag(s.decode('utf8'))
-                tagged_sentences.append(tagged_sent)
+            # Read tokenised raw sentences from the UDPipe output
+            raw_sentences = list(self.extract_sentences(fpath))
+            # Tag the sentences that are not in the sentence cache
+            tagged_sentences = [None] * len(raw_sentences)
+            if sentence_cache:
+                tagged_sentences = [sentence_cache.get(' '.join(sent)) for sent in raw_sentences]
+            untagged = [x for x in range(0, len(raw_sentences)) if tagged_sentences[x] is None]
+            tagged = st.tag_sentences([raw_sentences[x] for x in untagged])
+            for x, tagged_sent in izip(untagged, tagged):
+                tagged_sentences[x] = tagged_sent
+                if sentence_cache:
+                    sentence_cache.put(' '.join(raw_sentences[x]), tagged_sent)
             # Write tagged sentences to file
             outfilename = self.home + '/' + outdir + '/' + f
             with codecs.open(outfilename, 'w', 'utf-8') as outfile:
                 for sent in tagged_sentences:
                     for tok in sent:
-                        outfile.write(tok[0].lstrip('\n')+'\t'+tok[1]+'\n')
+                        outfile.write(tok[0]+'\t'+tok[1]+'\n')
                     outfile.write('\n')
+        st.close()
+        if sentence_cache:
+            sentence_cache.close()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Client of one or more Stanford NER servers that tags several sentences per
+request, with several requests in flight at a time
+
+The NER server handles one request per connection, so tagging sentence by
+sentence is limited by the round-trip time rather than by the CRF. Sentences
+are therefore packed into one request, separated by a sentinel sentence
+(". <sentinel> .", so that the server's sentence splitter keeps the sentences
+apart), and the tagged tokens are split back into sentences at the sentinel.
+If the number of tokens of any sentence in the response does not match the
+request (e.g. a token containing a space, which the server's whitespace
+tokenizer splits), the sentences of that request are tagged one at a time.
+
+Requests are sent from a pool of threads, each to the endpoint (NER server
+instance) with the fewest outstanding requests. The server closes the
+connection after each response, so connections cannot be kept open between
+requests. The number of requests in flight is adapted to the latency of the
+servers, and failed requests are retried (see adaptive.py).
+"""
+
+# Standard
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from sner.client import BaseClient
+
+# Custom
+import helper_functions as hf
+from adaptive import AdaptiveLimiter
+
+
+# Token separating the sentences of a batched request
+SENTINEL = 'NERBATCHSENTINEL'
+
+
+def parse_endpoints(endpoints, default_port=9199):
+    """
+    Parse a comma separated list of host:port endpoints
+    Return a list of (host, port) pairs
+    """
+    parsed = []
+    for endpoint in endpoints.split(','):
+        endpoint = endpoint.strip()
+        if endpoint == '':
+            continue
+        if ':' in endpoint:
+            host, port = endpoint.rsplit(':', 1)
+            parsed.append((host, int(port)))
+        else:
+            parsed.append((endpoint, default_port))
+    return parsed
+
+
+def get_endpoints(config):
+    """
+    Return the NER server endpoints specified in config: the list in "endpoints"
+    ("StanfordNER" section) if present, otherwise host_name at port 9199
+    """
+    endpoints = hf.get_config_value(config, 'StanfordNER', 'endpoints', '')
+    if endpoints.strip() != '':
+        return parse_endpoints(endpoints)
+    return [(config.get('StanfordNER','host_name'), 9199)]
+
+
+class Endpoint():
+
+    """
+    A NER server instance, with its number of outstanding requests
+    and request statistics
+    """
+
+    def __init__(self, host, port):
+        self.name = host + ':' + str(port)
+        # The base client returns the raw (slashTags) response
+        self.tagger = BaseClient(host, port)
+        self.outstanding = 0
+        self.requests = 0
+        self.sentences = 0
+        self.latency = 0.0
+
+
+class NerClient():
+
+    """
+    Tag (word tokenised) sentences using Stanford NER servers
+    endpoints is a list of (host, port) pairs, batch_size is the number of
+    sentences sent per request and concurrency the (maximum) number of requests
+    in flight
+    """
+
+    def __init__(self, endpoints, batch_size=1, concurrency=1, limiter=None):
+        self.endpoints = [Endpoint(host, port) for (host, port) in endpoints]
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.pool = ThreadPool(self.concurrency) if self.concurrency > 1 else None
+        self.lock = threading.Lock()
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter('NER', self.concurrency)
+        self.start = time.time()
+        # Number of batched requests that had to be repeated sentence by sentence
+        self.fallbacks = 0
+
+
+    def close(self):
+        """
+        Stop the request threads and log the statistics of each endpoint
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        elapsed = time.time() - self.start
+        for e in self.endpoints:
+            logging.info('NER endpoint %s: %d requests, %d sentences, mean latency %.1f ms, %.1f sentences/sec' %
+                         (e.name, e.requests, e.sentences, 1000 * e.latency / max(e.requests, 1),
+                          e.sentences / max(elapsed, 1e-9)))
+        self.limiter.log_stats()
+
+
+    def tag_sentences(self, sentences):
+        """
+        Tag a list of sentences (each a list of UTF-8 encoded tokens)
+        Return a list of tagged sentences, each a list of (token, tag) pairs
+        """
+        batches = [sentences[x:x+self.batch_size] for x in range(0, len(sentences), self.batch_size)]
+        if self.pool is not None:
+            tagged_batches = self.pool.map(self.tag_batch, batches, chunksize=1)
+        else:
+            tagged_batches = [self.tag_batch(b) for b in batches]
+        return [tagged for batch in tagged_batches for tagged in batch]
+
+
+    def tag_batch(self, sentences):
+        """
+        Tag a list of sentences in a single request
+        """
+        if len(sentences) == 1:
+            return [self.tag(sentences[0])]
+        separator = ' . ' + SENTINEL + ' . '
+        tagged = self.tag_text(separator.join(' '.join(s) for s in sentences), len(sentences))
+        # Split the tagged tokens at the sentinels
+        split = [[]]
+        for tok in tagged:
+            if tok[0] == SENTINEL:
+                split.append([])
+            else:
+                split[-1].append(tok)
+        # Remove the full stops of the separators
+        if len(split) == len(sentences):
+            for x in range(0, len(split)):
+                if x > 0:
+                    split[x] = split[x][1:]
+                if x < len(split)-1:
+                    split[x] = split[x][:-1]
+        if len(split) != len(sentences) or any(len(t) != len(s) for t, s in zip(split, sentences)):
+            logging.warning('NER batch of %d sentences misaligned, tagging sentence by sentence' %
+                            len(sentences))
+            with self.lock:
+                self.fallbacks += 1
+            return [self.tag(s) for s in sentences]
+        return split
+
+
+    def tag(self, tokens):
+        """
+        Tag a single sentence
+        """
+        return self.tag_text(' '.join(tokens), 1)
+
+
+    def tag_text(self, text, sentences):
+        """
+        Tag text (containing the given number of sentences), retrying if the request
+        fails, and return the list of (token, tag) pairs
+        """
+        return self.limiter.call(self.request, text, sentences)
+
+
+    def request(self, text, sentences):
+        """
+        Send text to the endpoint with the fewest outstanding requests
+        """
+        with self.lock:
+            endpoint = min(self.endpoints, key=lambda e: (e.outstanding, e.requests))
+            endpoint.outstanding += 1
+        start = time.time()
+        try:
+            response = endpoint.tagger.tag(text.decode('utf8'))
+        finally:
+            with self.lock:
+                endpoint.outstanding -= 1
+                endpoint.requests += 1
+                endpoint.sentences += sentences
+                endpoint.latency += time.time() - start
+        if response.strip() == '' and text.strip() != '':
+            raise IOError('empty response from NER server '+endpoint.name)
+        return [tuple(tok.rsplit('/', 1)) for tok in response.split() if '/' in tok]
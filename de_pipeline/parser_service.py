@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Dependency parsing with the UnstableParser as a single, long-lived service
+
+Building the UnstableParser network (TensorFlow graph, vocabularies and
+pre-trained embeddings) takes a long time and a lot of memory, so rather than
+each pool worker building its own, the network is built once, in a separate
+process started by main.py. Workers send the sentences of each batch file
+(CoNLL-U, as output by UDPipe) to the service through a local socket
+(multiprocessing.connection, authenticated with the key that all processes
+inherit from main.py), and receive the parsed sentences.
+
+The service collects the requests of several workers (until every connected
+worker has sent a request or pack_sentences sentences are waiting, for at
+most gather_time seconds), sorts their sentences by length and packs them
+into length buckets of up to bucket_tokens tokens, so that the minibatches
+the parser builds from each bucket hold sentences of similar length (little
+padding). All buckets of a
+round are parsed in one call to the network, and the parsed sentences are
+returned to each worker in the order of its file. The number of sentences
+and sentences/sec are logged for every round and when the service stops.
+"""
+
+# Standard
+import os
+import time
+import Queue
+import shutil
+import logging
+import tempfile
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+# Custom
+import helper_functions as hf
+
+
+def get_address(config):
+    """
+    Return the path of the socket of the parser service ("service_socket" in
+    the "UnstableParser" section, relative to the home directory)
+    """
+    home = config.get('General','home')
+    return home + '/' + hf.get_config_value(config, 'UnstableParser', 'service_socket', 'parser_service.sock')
+
+
+def sentence_length(block):
+    """
+    Number of words of a CoNLL-U sentence (multi-word tokens and empty nodes are not counted)
+    """
+    length = 0
+    for line in block.split('\n'):
+        if line != '' and line[0] != '#':
+            token_id = line.split('\t', 1)[0]
+            if '-' not in token_id and '.' not in token_id:
+                length += 1
+    return length
+
+
+def pack(sentences, bucket_tokens):
+    """
+    Sort sentences (a list of (key, CoNLL-U block) pairs) by length and split
+    them into buckets of up to bucket_tokens tokens (a longer sentence gets a
+    bucket of its own)
+    Return a list of buckets, each a list of (key, block) pairs
+    """
+    ordered = sorted((sentence_length(block), key, block) for key, block in sentences)
+    buckets = []
+    tokens = 0
+    for length, key, block in ordered:
+        if buckets == [] or tokens + length > bucket_tokens:
+            buckets.append([])
+            tokens = 0
+        buckets[-1].append((key, block))
+        tokens += length
+    return buckets
+
+
+def read_parsed(filename):
+    """
+    Read the sentences of a file written by the parser, each ending in one empty line
+    """
+    with open(filename) as f:
+        return [block.rstrip('\n') + '\n\n' for block in hf.read_conllu_blocks(f)]
+
+
+class ParserService():
+
+    """
+    The parser service, run in its own process
+    start() starts the process and returns once it accepts connections (the
+    model is loaded in the background; requests wait until it is loaded),
+    stop() stops it after the requests received so far have been answered
+    """
+
+    def __init__(self, config):
+        self.address = get_address(config)
+        self.parserpath = config.get('UnstableParser','path')
+        self.savedir = config.get('UnstableParser','save_dir')
+        self.gather_time = hf.get_config_value(config, 'UnstableParser', 'gather_time', 0.5)
+        self.pack_sentences = hf.get_config_value(config, 'UnstableParser', 'pack_sentences', 5000)
+        self.bucket_tokens = hf.get_config_value(config, 'UnstableParser', 'bucket_tokens', 5000)
+        self.process = None
+        # Number of connected workers
+        self.connected = 0
+        self.lock = threading.Lock()
+
+
+    def start(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        ready = mp.Event()
+        self.process = mp.Process(target=self.run, args=(ready,))
+        self.process.daemon = True
+        self.process.start()
+        ready.wait()
+
+
+    def stop(self):
+        connection = Client(self.address, 'AF_UNIX')
+        connection.send(('stop',))
+        connection.close()
+        self.process.join()
+
+
+    def run(self, ready):
+        """
+        Main method of the service process
+        """
+        listener = Listener(self.address, 'AF_UNIX')
+        requests = Queue.Queue()
+        accept = threading.Thread(target=self.accept, args=(listener, requests))
+        accept.daemon = True
+        accept.start()
+        ready.set()
+        network = None
+        error = None
+        try:
+            start = time.time()
+            network = self.load_network()
+            logging.info('parser service: loaded the UnstableParser model in %.1fs' % (time.time() - start))
+        except Exception as e:
+            logging.error('parser service: cannot load the UnstableParser model\n'+traceback.format_exc())
+            error = 'cannot load the UnstableParser model: '+str(e)
+        self.serve(network, error, requests)
+        listener.close()
+
+
+    def load_network(self):
+        """
+        Build the UnstableParser network (the parser path is added to sys.path by main.py)
+        """
+        import unstable_parser as up
+        return up.UnstableParser(self.parserpath, self.savedir)
+
+
+    def accept(self, listener, requests):
+        """
+        Accept connections from the workers, handling each in its own thread
+        """
+        while True:
+            connection = listener.accept()
+            handler = threading.Thread(target=self.handle, args=(connection, requests))
+            handler.daemon = True
+            handler.start()
+
+
+    def handle(self, connection, requests):
+        """
+        Pass the requests received on a connection to the parsing thread and send back the results
+        """
+        reply = Queue.Queue()
+        with self.lock:
+            self.connected += 1
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break
+            if message[0] == 'stop':
+                requests.put(None)
+                break
+            name, sentences = message[1], message[2]
+            if sentences == []:
+                connection.send(('ok', []))
+                continue
+            requests.put((name, sentences, reply))
+            connection.send(reply.get())
+        with self.lock:
+            self.connected -= 1
+        connection.close()
+
+
+    def serve(self, network, error, requests):
+        """
+        Parse the requests in rounds, until the service is stopped
+        """
+        start = time.time()
+        busy = 0.0
+        total = 0
+        stopping = False
+        while not stopping:
+            request = requests.get()
+            if request is None:
+                break
+            # Collect the requests of the other workers, for up to gather_time seconds
+            batch = [request]
+            waiting = len(request[1])
+            deadline = time.time() + self.gather_time
+            while waiting < self.pack_sentences and len(batch) < self.connected:
+                try:
+                    request = requests.get(timeout=max(0.001, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                waiting += len(request[1])
+            if error is not None:
+                for name, sentences, reply in batch:
+                    reply.put(('error', error))
+                continue
+            round_start = time.time()
+            try:
+                results = self.parse(network, batch)
+            except Exception as e:
+                logging.error('parser service: parsing failed\n'+traceback.format_exc())
+                for name, sentences, reply in batch:
+                    reply.put(('error', 'parsing failed: '+str(e)))
+                continue
+            elapsed = time.time() - round_start
+            busy += elapsed
+            total += waiting
+            logging.info('parser service: parsed %d sentences from %d files in %.1fs, %.1f sentences/sec' %
+                         (waiting, len(batch), elapsed, waiting / max(elapsed, 1e-9)))
+            for (name, sentences, reply), parsed in zip(batch, results):
+                reply.put(('ok', parsed))
+        logging.info('parser service: stopped after %.1fs; parsed %d sentences in %.1fs, %.1f sentences/sec' %
+                     (time.time() - start, total, busy, total / max(busy, 1e-9)))
+
+
+    def parse(self, network, batch):
+        """
+        Parse the sentences of a list of requests, packed into length buckets
+        Return the list of parsed sentences of each request
+        """
+        sentences = [((r, s), block) for r in range(0,len(batch)) for s, block in enumerate(batch[r][1])]
+        buckets = pack(sentences, self.bucket_tokens)
+        workdir = tempfile.mkdtemp(prefix='parser_service')
+        try:
+            indir = workdir + '/in'
+            outdir = workdir + '/out'
+            os.mkdir(indir)
+            os.mkdir(outdir)
+            infiles = []
+            for b in range(0,len(buckets)):
+                infile = indir + '/bucket%d.conllu' % b
+                with open(infile, 'w') as f:
+                    for key, block in buckets[b]:
+                        f.write(block)
+                infiles.append(infile)
+            network.parse(outdir, infiles)
+            results = [[None] * len(request[1]) for request in batch]
+            for infile, bucket in zip(infiles, buckets):
+                parsed = read_parsed(outdir + '/' + infile.split('/')[-1])
+                if len(parsed) != len(bucket):
+                    raise ValueError('parser returned %d sentences for %d' % (len(parsed), len(bucket)))
+                for ((r, s), block), parsed_block in zip(bucket, parsed):
+                    results[r][s] = parsed_block
+        finally:
+            shutil.rmtree(workdir)
+        return results
+
+
+class ParserClient():
+
+    """
+    Connection of a worker process to the parser service
+    """
+
+    def __init__(self, address):
+        self.connection = Client(address, 'AF_UNIX')
+
+
+    def parse(self, name, sentences):
+        """
+        Parse a list of sentences (CoNLL-U blocks) of file name
+        Return the list of parsed sentences
+        """
+        self.connection.send(('parse', name, sentences))
+        status, result = self.connection.recv()
+        if status != 'ok':
+            raise RuntimeError('parser service: '+result)
+        return result
+
+
+# Connection to the parser service of each process, keyed by (address, process ID)
+_clients = {}
+
+
+def get_client(config):
+    """
+    Return the connection of this process to the parser service, opening it on first use
+    """
+    key = (get_address(config), os.getpid())
+    if key not in _clients:
+        _clients[key] = ParserClient(key[0])
+    return _clients[key]
+
+
+def close_clients():
+    """
+    Close the connections of this process to the parser service
+    """
+    for key in _clients.keys():
+        if key[1] == os.getpid():
+            _clients.pop(key).connection.close()
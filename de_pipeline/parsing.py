@@ -8,14 +8,17 @@ import ConfigParser
 import logging
 
 # Custom
-import unstable_parser as up
+import cache
+import parser_service as ps
+import helper_functions as hf
 import unstable_parser_post_proc as postproc
 
 
 class UnstParser():
 
     """
-    Perform dependency parsing using the UnstableParser
+    Perform dependency parsing using the UnstableParser (run as a service
+    shared by all worker processes, see parser_service.py)
     Input: CoNLL format files (containing segmented, word tokenised sentences)
     Output: CoNLL format files with dependencies and POS-tags
     """
@@ -25,6 +28,13 @@ class UnstParser():
         # Get home directory
         self.home = self.config.get('General','home')
 
+
+    def load_resources(self):
+        """
+        Connect to the parser service (called once per worker process)
+        """
+        ps.get_client(self.config)
+
         
     def process(self, files):
         """
@@ -39,24 +49,42 @@ class UnstParser():
 
     def unstable_parser(self, files):
         """
-        Parse with the UnstableParser
+        Parse with the UnstableParser: send the sentences of each file (other
+        than those in the sentence cache) to the parser service
         """
-        # Parser path
-        parserpath = self.config.get('UnstableParser','path')
         # Get input directory (output of udpipe)
         indir = self.config.get('UDPipe','out_dir')
-        # Get UnstableParser configurations
-#        parserconfig = self.config.get('UnstableParser','config_file')
-        savedir = self.config.get('UnstableParser','save_dir')
         outdir = self.config.get('UnstableParser','out_dir')
-        file_list = [self.home+'/'+indir+'/'+f for f in files]
-        # Initialise parser
-        logging.info('Initialising the UnstableParser:')
-        uparser = up.UnstableParser(parserpath, savedir)
-        # Parse each file
-        outputdir = self.home + '/' + outdir
+        client = ps.get_client(self.config)
+        sentence_cache = cache.get_sentence_cache(self.config, 'parse')
         logging.info('Parsing input files in: ' + indir)
-        uparser.parse(outputdir, file_list)
+        for f in files:
+            with open(self.home+'/'+indir+'/'+f) as i:
+                sentences = list(hf.read_conllu_blocks(i))
+            parsed = [None] * len(sentences)
+            if sentence_cache:
+                for x in range(0,len(sentences)):
+                    cached = sentence_cache.get(self.cache_key(sentences[x]))
+                    if cached is not None:
+                        parsed[x] = cached.encode('utf-8')
+            to_parse = [x for x in range(0,len(sentences)) if parsed[x] is None]
+            results = client.parse(f, [sentences[x] for x in to_parse])
+            for x, block in zip(to_parse, results):
+                parsed[x] = block
+                if sentence_cache:
+                    sentence_cache.put(self.cache_key(sentences[x]), block.decode('utf-8'))
+            with open(self.home+'/'+outdir+'/'+f, 'w') as o:
+                for block in parsed:
+                    o.write(block)
+        if sentence_cache:
+            sentence_cache.close()
+
+
+    def cache_key(self, sentence):
+        """
+        Sentence cache key of a CoNLL-U sentence: its lines without the comments
+        """
+        return '\n'.join(line for line in sentence.split('\n') if not line.startswith('#'))
         
 
     def post_process_parsed_output(self, files):
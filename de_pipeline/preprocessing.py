@@ -2,18 +2,43 @@
 # -*- coding: utf-8 -*-
 
 # Standard
+import os
 import sys
+import shutil
 import codecs
+import traceback
 import logging
 import json
-import nltk.data
+import multiprocessing as mp
 from datetime import datetime
+from functools import partial
+from itertools import chain, imap
 
 # Custom
-import udpipe_model as udp
+import resources as res
+import segmenter as seg
+import corpus_input as ci
+import dedup
+import cache
 import helper_functions as hf
 
 
+# CoNLL-U comments written by UDPipe that depend on the position of a sentence in the file
+POSITIONAL_COMMENTS = ('# newdoc', '# newpar', '# sent_id')
+
+
+def segment_shard(shard, preprocessor):
+    """
+    Segment the articles in a shard of the corpus
+    Defined at module level so that it can be sent to a process pool
+    """
+    try:
+        return preprocessor.segment_shard(shard)
+    except Exception, ex:
+        print traceback.format_exc()
+        raise ex
+
+
 class Preprocessor():
 
     """
@@ -31,60 +56,197 @@ class Preprocessor():
         self.home = self.config.get('General','home')
     
     
-    def batch_and_segment(self):
+    def batch_and_segment(self, cores=1, pool=None):
         """
         Read the JSON format corpus files, batch articles according to batch_size
-        specified in config and output (per batch):
+        and batch_unit specified in config and output (per batch):
             * a file containing the lines from all articles in the bacth
             * a mapping file that lists the article ID corresponding to each line
+        The corpus is split into shards of roughly shard_size MB, which are
+        parsed and segmented in parallel. Batches are then written in the order
+        of the corpus, so the output does not depend on the number of cores used.
+        If no pool of workers is given, one is created for the number of cores.
         """
         logging.info('in batch and segment: '+str(datetime.now()))
-        filenames = []
-        indir = self.config.get('Input','json_dir')
-        infile = self.config.get('Input', 'json_file')
         outdir = self.config.get('Preprocessor','out_dir')
         batchsize = self.config.getint('General', 'batch_size')
         batchfile = self.home + '/' + self.config.get('General', 'batches_file')
         outfilepath = self.home+'/'+outdir
+        shards = self.get_shards()
+        segment = partial(segment_shard, preprocessor=self)
+        if pool is not None:
+            articles = chain.from_iterable(hf.bounded_imap(pool, segment, shards, 2*cores))
+            batches = self.write_batches(articles, outfilepath, batchsize)
+        elif cores > 1:
+            pool = mp.Pool(processes=cores)
+            try:
+                articles = chain.from_iterable(hf.bounded_imap(pool, segment, shards, 2*cores))
+                batches = self.write_batches(articles, outfilepath, batchsize)
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            pool.join()
+        else:
+            articles = chain.from_iterable(imap(segment, shards))
+            batches = self.write_batches(articles, outfilepath, batchsize)
+        # Write list of batch file names (and estimated sizes) to file:
+        hf.write_string_list_to_file([name+'\t'+str(size) for (name, size) in batches], batchfile)
+        logging.info('written names of batches to file: '+str(datetime.now()))
+
+
+    def get_shards(self):
+        """
+        Split the corpus into shards for segmentation
+        A single uncompressed corpus file is split into line-aligned byte ranges,
+        which are read by the segmenting processes. Otherwise the corpus files are
+        streamed (and decompressed) in the background, in chunks of lines.
+        """
+        shardsize = hf.get_config_value(self.config, 'Preprocessor', 'shard_size', 16)*1024*1024
+        infiles = ci.get_input_files(self.config)
+        if infiles == []:
+            raise IOError("No corpus files match '%s'" % self.config.get('Input','json_file'))
+        if len(infiles) == 1 and not ci.is_compressed(infiles[0]):
+            ranges = hf.split_file_into_line_ranges(infiles[0], shardsize)
+            logging.info('split input file into '+str(len(ranges))+' shards: '+str(datetime.now()))
+            return [(infiles[0], start, end) for (start, end) in ranges]
+        logging.info('streaming '+str(len(infiles))+' input files: '+str(datetime.now()))
+        prefetch = hf.get_config_value(self.config, 'Preprocessor', 'prefetch_files', 2)
+        return ci.CorpusReader(infiles, shardsize, prefetch)
+
+
+    def segment_shard(self, shard):
+        """
+        Segment the articles in a shard of the JSON format corpus: either a
+        (file name, start, end) byte range of a corpus file, or a list of lines
+        Return a list of (article ID, list of sentences, CoNLL-U) tuples, in corpus order
+        """
+        if isinstance(shard, tuple):
+            filename, start, end = shard
+            with open(filename, 'rb') as ifile:
+                ifile.seek(start)
+                lines = ifile.read(end - start).split('\n')
+        else:
+            lines = shard
+        # MinHash settings for near-duplicate detection (None if disabled)
+        minhash = None
+        if hf.get_config_value(self.config, 'Dedup', 'enabled', False):
+            minhash = (hf.get_config_value(self.config, 'Dedup', 'num_perm', 64),
+                       hf.get_config_value(self.config, 'Dedup', 'shingle_size', 5))
+        return [self.segment_article(line, minhash) for line in lines if line.strip() != '']
+
+
+    def segment_article(self, line, minhash=None):
+        """
+        Extract the article ID and text from a JSON object, and segment the text
+        Return the article ID, the list of sentences, the CoNLL-U tokenised sentences
+        (None unless the segmenter word tokenises), the (estimated) number of tokens
+        and the MinHash signature of the article (None unless minhash settings
+        (number of permutations, shingle size) are given)
+        """
+        data = json.loads(line)
+        articleid = data['articleId']
+        textlist = data['text'].split('\n')
+        segtextlist, conllu = seg.get_segmenter(self.config).segment_and_tokenize(textlist)
+        tokencount = sum(len(s.split()) for s in segtextlist)
+        signature = None
+        if minhash is not None:
+            signature = dedup.minhash_signature(segtextlist, minhash[0], minhash[1])
+        return (articleid, segtextlist, conllu, tokencount, signature)
+
+
+    def write_batches(self, articles, outpath, batchsize):
+        """
+        Collect segmented articles into batches and write the batch files
+        A batch is closed once it holds batchsize units, as specified in config
+        by "batch_unit": articles (default), sentences or tokens. Articles are
+        never split across batches.
+        If near-duplicate detection is enabled in config, articles that are
+        near-duplicates of an earlier article are left out of the batches, and
+        listed (with the ID of the earlier article) in the duplicates map file.
+        Return a list of (batch file name, estimated size in tokens) tuples
+        """
+        batchunit = hf.get_config_value(self.config, 'General', 'batch_unit', 'articles')
+        if batchunit not in ['articles', 'sentences', 'tokens']:
+            raise ValueError("Unknown batch unit '%s'" % batchunit)
+        batches = []
         batchcounter = 0
+        batchtokens = 0
         batchtextlist = []
         batchmaplist = []
-        with open(self.home+'/'+indir+'/'+infile, 'r') as ifile:
-            logging.info('started loop that goes trough infile: '+str(datetime.now()))
-            for line in ifile:
-                batchcounter += 1
-                # Extract JSON object
-                data = json.loads(line)
-                articleid = data['articleId']
-                textlist = data['text'].split('\n')
-                # Segment text
-                segtextlist = self.split_sentences(textlist)
+        batchconllulist = []
+        deduplicator = self.get_deduplicator()
+        dupfile = None
+        if deduplicator is not None:
+            dupfile = open(self.home+'/'+hf.get_config_value(self.config, 'Dedup', 'map_file', 'duplicates.tsv'), 'w')
+            totals = [0, 0, 0]
+            removed = [0, 0, 0]
+        try:
+            for articleid, segtextlist, conllu, tokencount, signature in articles:
+                if deduplicator is not None:
+                    counts = [1, len(segtextlist), tokencount]
+                    totals = [x + y for (x, y) in zip(totals, counts)]
+                    original = deduplicator.find_duplicate(articleid, signature)
+                    if original is not None:
+                        dupfile.write(str(articleid)+'\t'+str(original)+'\n')
+                        removed = [x + y for (x, y) in zip(removed, counts)]
+                        continue
+                if batchunit == 'articles':
+                    batchcounter += 1
+                elif batchunit == 'sentences':
+                    batchcounter += len(segtextlist)
+                else:
+                    batchcounter += tokencount
+                batchtokens += tokencount
                 # Add text and article IDs to lists (to be written in batches)
                 batchtextlist += segtextlist
-                articlelinecount = len(segtextlist)
-                batchmaplist += [articleid]*articlelinecount
-                logging.info('add stuff to be written in batchfile: '+str(datetime.now())+' articelId:'+str(articleid))
+                batchmaplist += [articleid]*len(segtextlist)
+                if conllu is not None:
+                    batchconllulist.append(conllu)
                 # Write batches
-                if batchcounter == batchsize:
-                    fname = self.write_batch_files(outfilepath, batchsize, batchtextlist, batchmaplist)
+                if batchcounter >= batchsize:
+                    fname = self.write_batch_files(outpath, batchsize, batchtextlist, batchmaplist, batchconllulist)
+                    batches.append((fname, batchtokens))
                     batchcounter = 0
+                    batchtokens = 0
                     batchtextlist = []
                     batchmaplist = []
-                    filenames.append(fname)
+                    batchconllulist = []
                     logging.info('written batches: '+str(datetime.now()))
-        # Write final batch (remainder of articles)
-        if batchtextlist != []:
-            fname = self.write_batch_files(outfilepath, batchsize, batchtextlist, batchmaplist)
-            filenames.append(fname)
-            logging.info('written final batches: '+str(datetime.now()))
-        # Write list of batch file names to file:
-        hf.write_string_list_to_file(filenames,batchfile)
-        logging.info('written names of batches to file: '+str(datetime.now()))
+            # Write final batch (remainder of articles)
+            if batchtextlist != []:
+                fname = self.write_batch_files(outpath, batchsize, batchtextlist, batchmaplist, batchconllulist)
+                batches.append((fname, batchtokens))
+                logging.info('written final batches: '+str(datetime.now()))
+        finally:
+            if dupfile is not None:
+                dupfile.close()
+        if deduplicator is not None:
+            message = 'near-duplicates removed: '
+            for unit, r, t in zip(['articles', 'sentences', 'tokens'], removed, totals):
+                message += '%d/%d %s (%.1f%%) ' % (r, t, unit, 100.0 * r / max(t, 1))
+            logging.info(message)
+            print(message)
+        return batches
+
+
+    def get_deduplicator(self):
+        """
+        Create a near-duplicate detector with the settings in the "Dedup"
+        section of config, or return None if near-duplicate detection is disabled
+        """
+        if not hf.get_config_value(self.config, 'Dedup', 'enabled', False):
+            return None
+        return dedup.MinHashDeduplicator(hf.get_config_value(self.config, 'Dedup', 'bands', 8),
+                                         hf.get_config_value(self.config, 'Dedup', 'threshold', 0.8),
+                                         hf.get_config_value(self.config, 'Dedup', 'max_articles', 100000))
 
 
-    def write_batch_files(self, outpath, batchsize, batchtextlist, batchmaplist):
+    def write_batch_files(self, outpath, batchsize, batchtextlist, batchmaplist, batchconllulist=[]):
         """
         Write the batched files: article text and article line mapping file
+        If the segmenter also tokenised the text, write the tokenised sentences
+        to a CoNLL-U file (read by the UDPipe step in place of the article text)
         Return the name of the batched article text file (will be added to a list for later use)
         """
         batchtextfilename = 'batch_size'+str(batchsize)+'_'+str(batchmaplist[0])+'_'+str(batchmaplist[-1])
@@ -95,58 +257,203 @@ class Preprocessor():
         # Write batch mapping file
         with open(outpath+'/'+batchmapfilename, 'w') as ofile:
             ofile.write('\n'.join(str(x) for x in batchmaplist)+'\n')
+        # Write tokenised sentences
+        if batchconllulist != []:
+            with codecs.open(outpath+'/'+batchtextfilename+'.conllu', 'w', 'utf-8') as ofile:
+                ofile.write(''.join(batchconllulist))
         return batchtextfilename
 
         
     def split_sentences(self, textlist):
         """
-        Split sentences using NLTKs PunktTokenizer
-        Use segmentation model specifed in config.ini as "seg_model"
+        Split sentences using the segmentation engine specified in config.ini
+        as "seg_engine" (NLTKs PunktTokenizer by default, using the model
+        specifed as "seg_model")
         """
-        segs = []
-        model = self.config.get('Preprocessor','seg_model')
-        splitter = nltk.data.load(model)
-        for text in textlist:
-            if text != '':
-                segs += splitter.tokenize(text)
-        return segs
+        return seg.get_segmenter(self.config).segment(textlist)
                     
             
-    def process(self, files):
+    def load_resources(self):
         """
-        Main method
-        Preprocess with UDPipe to get CoNLL format files
+        Load the models used by this step (called once per worker process)
+        """
+        self.get_model()
+        seg.get_segmenter(self.config)
+
+
+    def get_model(self):
+        """
+        Get the UDPipe model specified in config
+        The model is loaded once per process and reused for all subsequent batches
         """
-        # Get UDPipe configurations
-        indir = self.config.get('Preprocessor','out_dir')
-        outformat = self.config.get('UDPipe','out_format')
-        outdir = self.config.get('UDPipe','out_dir')
         modelfile = self.config.get('UDPipe','model')
-        # Load the model
-        logging.info('Loading model: ')  
         try:
-            model = udp.UDPipeModel(modelfile)
+            return res.get_udpipe_model(modelfile)
         except Exception:
             message = "ERROR: Cannot load model from file '%s'\n" % modelfile
             logging.error(message+'  Exited at: '+str(datetime.now())+'\n\n')
             sys.stderr.write(message)
             sys.exit(1)
-        logging.info('...complete')
+
+
+    def get_annotation_mode(self):
+        """
+        Get the UDPipe annotation mode specified in config as "mode":
+            * parse - tokenise, tag and parse (default)
+            * tag - tokenise and tag only
+            * tokenize - tokenise only
+        The dependency parse can only be skipped when an external parser
+        (re-)parses the UDPipe output; otherwise the mode is always "parse"
+        """
+        mode = hf.get_config_value(self.config, 'UDPipe', 'mode', 'parse')
+        if mode not in ['parse', 'tag', 'tokenize']:
+            raise ValueError("Unknown UDPipe mode '%s'" % mode)
+        if mode != 'parse' and not hf.external_parser_selected(self.config):
+            logging.warning('UDPipe mode "'+mode+'" ignored: the UDPipe parse is used by the pipeline')
+            mode = 'parse'
+        return mode
+
+
+    def process(self, files):
+        """
+        Main method
+        Preprocess with UDPipe to get CoNLL format files
+        """
+        # Get UDPipe configurations
+        indir = self.config.get('Preprocessor','out_dir')
+        outformat = self.config.get('UDPipe','out_format')
+        outdir = self.config.get('UDPipe','out_dir')
+        model = self.get_model()
+        annotation = self.get_annotation_mode()
         # Process input files
-        logging.info('Processing input files:')
+        logging.info('Processing input files (UDPipe mode: '+annotation+'):')
+        # Text already tokenised by the segmenter is read from the CoNLL-U batch files
+        pretokenized = seg.engine_tokenizes(self.config)
+        sentence_cache = cache.get_sentence_cache(self.config, 'udpipe-'+annotation+'-'+outformat)
         for f in files:
             infile = self.home + '/' + indir + '/' + f
+            if pretokenized:
+                infile += '.conllu'
             logging.info('  '+infile)
-            # Read text
-            with open(infile) as i:
-                text = ''.join(i.readlines())
-            # Tokenise, tag, and parse
-            sentences = model.tokenize(text)
-            for s in sentences:
+            outfile = self.home+'/'+outdir+'/'+f
+            # Stream the text one sentence at a time: tokenise (unless already
+            # tokenised), tag and parse it, and write it to the output file, so
+            # that memory use does not depend on the size of the batch
+            with open(infile) as i, codecs.open(outfile, 'w', 'utf-8') as o:
+                chunks = hf.read_conllu_blocks(i) if pretokenized else i
+                if sentence_cache:
+                    self.annotate_cached(model, chunks, pretokenized, annotation, outformat, sentence_cache, o)
+                    continue
+                if pretokenized:
+                    sentences = model.read_stream(chunks, 'conllu')
+                else:
+                    sentences = model.tokenize_stream(chunks)
+                model.write_stream(self.annotate(model, sentences, annotation), outformat, o)
+        if sentence_cache:
+            sentence_cache.close()
+        # With the udpipe parser backend, the UDPipe parse is the dependency parse used by the pipeline
+        if not hf.external_parser_selected(self.config):
+            self.publish_parse(files)
+
+
+    def publish_parse(self, files):
+        """
+        Make the UDPipe output available as the dependency parse read by the
+        entity extraction and relation extraction steps (post_proc_out_dir),
+        in place of the re-parsed and post-processed UnstableParser output
+        The files are hard-linked (or copied, if linking is not possible)
+        """
+        outdir = self.home + '/' + self.config.get('UDPipe','out_dir')
+        parsedir = self.home + '/' + self.config.get('UnstableParser','post_proc_out_dir')
+        if os.path.abspath(outdir) == os.path.abspath(parsedir):
+            return
+        for f in files:
+            target = parsedir + '/' + f
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(outdir + '/' + f, target)
+            except OSError:
+                shutil.copyfile(outdir + '/' + f, target)
+
+
+    def annotate(self, model, sentences, annotation):
+        """
+        Tag and parse each sentence (as required by the UDPipe mode) and yield it
+        """
+        for s in sentences:
+            if annotation != 'tokenize':
                 model.tag(s)
+            if annotation == 'parse':
                 model.parse(s)
-            # Output to file
-            conllu = model.write(sentences, outformat)
-            outfile = self.home+'/'+outdir+'/'+f
-            with codecs.open(outfile, 'w', 'utf-8') as o:
-                o.write(conllu)
+            yield s
+
+
+
+    def annotate_cached(self, model, chunks, pretokenized, annotation, outformat, sentence_cache, outfile):
+        """
+        Annotate each input sentence (line of text, or CoNLL-U block if already tokenised)
+        and write it to outfile, taking the annotated sentence from the sentence cache if it is there
+        The output is the same as without the cache: the CoNLL-U comments that depend on
+        the position of a sentence in the file are not cached, but written for each sentence
+        """
+        tokenizer = None if pretokenized else model.new_tokenizer()
+        conllu = outformat == 'conllu'
+        # Comments left out of the cache: all of them for tokenised input (they
+        # are copied from the input), only the positional ones otherwise
+        uncached_comments = '#' if pretokenized else POSITIONAL_COMMENTS
+        sentence_id = 0
+        newdoc = True
+        newpar = True
+        for chunk in chunks:
+            if chunk.strip() == '':
+                # An empty line of text starts a new paragraph
+                newpar = True
+                continue
+            key = chunk
+            if pretokenized:
+                # Key on the tokens: the comments of the input are copied to the output
+                key = ''.join(l for l in chunk.splitlines(True) if not l.startswith('#'))
+            output = sentence_cache.get(key)
+            if output is None:
+                if pretokenized:
+                    sentences = model.read_stream([chunk], 'conllu')
+                else:
+                    sentences = model.tokenize_stream([chunk], tokenizer)
+                output = model.write(self.annotate(model, sentences, annotation), outformat)
+                if conllu:
+                    output = ''.join(l for l in output.splitlines(True) if not l.startswith(uncached_comments))
+                sentence_cache.put(key, output)
+            if conllu and pretokenized:
+                output = ''.join(l for l in chunk.splitlines(True) if l.startswith('#')).decode('utf-8') + output
+            elif conllu:
+                output, sentence_id = self.add_positional_comments(output, sentence_id, newdoc, newpar)
+                newdoc = False
+                newpar = False
+            outfile.write(output)
+
+
+    def add_positional_comments(self, output, sentence_id, newdoc, newpar):
+        """
+        Add the comments that depend on the position of a sentence in the file
+        (new document, new paragraph and sentence ID, as UDPipe writes them) to
+        CoNLL-U output of one or more sentences, numbered from sentence_id + 1
+        Return the output and the ID of its last sentence
+        """
+        lines = []
+        start = True
+        for line in output.splitlines(True):
+            if line.strip() == '':
+                start = True
+            elif start:
+                if newdoc:
+                    lines.append(u'# newdoc\n')
+                if newpar:
+                    lines.append(u'# newpar\n')
+                newdoc = False
+                newpar = False
+                sentence_id += 1
+                lines.append(u'# sent_id = %d\n' % sentence_id)
+                start = False
+            lines.append(line)
+        return ''.join(lines), sentence_id
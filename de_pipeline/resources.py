@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-process cache of expensive pipeline resources
+
+Models, mapping files, HTTP sessions and request limiters are loaded the first time they are
+requested by a process and then shared by every pipeline step and batch
+handled by that process. main.py loads the resources that the pipeline
+steps need (see load_resources in the step classes) before it creates the
+worker pool, so that a missing resource stops the pipeline at once, and the
+workers inherit them.
+"""
+
+# Standard
+import gzip
+import requests
+import simplejson as json
+from sys import platform
+
+# Custom
+import udpipe_model as udp
+import type_map as tm
+import adaptive
+
+
+# Resources loaded by this process, keyed by (resource type, path)
+_resources = {}
+
+
+def get_udpipe_model(path):
+    """
+    Return the UDPipe model stored at path
+    """
+    key = ('udpipe', path)
+    if key not in _resources:
+        _resources[key] = udp.UDPipeModel(path)
+    return _resources[key]
+
+
+def get_type_map(path):
+    """
+    Return the DBPedia to FIGER mapping stored at path
+    A compiled map (see type_map.py) is memory-mapped, and so shared by all
+    processes; a map in the gzipped JSON format is loaded into a dictionary
+    """
+    key = ('type_map', path)
+    if key not in _resources:
+        if tm.is_type_map(path):
+            _resources[key] = tm.TypeMap(path)
+        else:
+            with gzip.open(path, 'r') as mfile:
+                _resources[key] = json.load(mfile)
+    return _resources[key]
+
+
+def get_http_session(pool_size=10):
+    """
+    Return an HTTP session for this process, so that connections to the
+    same server are kept alive and reused across requests
+    Up to pool_size connections per server are kept open (one per request
+    thread)
+    """
+    key = ('http_session', pool_size)
+    if key not in _resources:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # Solution for mac OSX problem whereby requests hang with multiprocessing
+        # https://stackoverflow.com/questions/30453152/python-multiprocessing-and-requests
+        if platform == 'darwin':
+            session.trust_env = False
+        _resources[key] = session
+    return _resources[key]
+
+
+def get_limiter(config, section, name, max_limit):
+    """
+    Return the limiter of the requests of this process to the service whose
+    settings are in the given config section (see adaptive.py), so that the
+    request limit and latency baseline it has learned carry over from batch
+    to batch
+    """
+    key = ('limiter', section, max_limit)
+    if key not in _resources:
+        _resources[key] = adaptive.get_limiter(config, section, name, max_limit)
+    return _resources[key]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sentence segmentation engines used when batching the corpus
+    * punkt - NLTK's PunktTokenizer, using the model specified as "seg_model"
+    * udpipe - UDPipe's tokenizer, which segments and word tokenises in one pass
+The engine is selected with the "seg_engine" setting in the "Preprocessor"
+section of the config file. Segmenters are cached, so each model is loaded
+at most once per process.
+"""
+
+# Standard
+import nltk.data
+
+# Custom
+import resources as res
+import helper_functions as hf
+
+
+# Segmenters loaded by this process, keyed by (engine, model path)
+_segmenters = {}
+
+
+def get_engine(config):
+    """
+    Return the name of the segmentation engine specified in config,
+    and the path of the model that it uses
+    """
+    engine = hf.get_config_value(config, 'Preprocessor', 'seg_engine', 'punkt')
+    if engine == 'punkt':
+        return (engine, config.get('Preprocessor','seg_model'))
+    elif engine == 'udpipe':
+        return (engine, config.get('UDPipe','model'))
+    raise ValueError("Unknown sentence segmentation engine '%s'" % engine)
+
+
+def engine_tokenizes(config):
+    """
+    Check whether the segmentation engine specified in config also word tokenises
+    """
+    return get_engine(config)[0] == 'udpipe'
+
+
+def get_segmenter(config):
+    """
+    Return the segmenter specified in config, loading its model
+    if it has not yet been loaded by this process
+    """
+    key = get_engine(config)
+    if key not in _segmenters:
+        engine, model = key
+        if engine == 'punkt':
+            _segmenters[key] = PunktSegmenter(model)
+        else:
+            _segmenters[key] = UDPipeSegmenter(model)
+    return _segmenters[key]
+
+
+class PunktSegmenter():
+
+    """
+    Split sentences using NLTKs PunktTokenizer
+    """
+
+    # Output is sentence segmented only (not word tokenised)
+    tokenizes = False
+
+    def __init__(self, model):
+        self.splitter = nltk.data.load(model)
+
+
+    def segment(self, textlist):
+        """
+        Split each (non-empty) paragraph into sentences
+        Return a list of sentence strings
+        """
+        segs = []
+        for text in textlist:
+            if text != '':
+                segs += self.splitter.tokenize(text)
+        return segs
+
+
+    def segment_and_tokenize(self, textlist):
+        """
+        Punkt does not word tokenise, so no CoNLL-U output is produced
+        """
+        return (self.segment(textlist), None)
+
+
+class UDPipeSegmenter():
+
+    """
+    Split sentences using the tokenizer of a UDPipe model
+    The tokenised sentences can be written in CoNLL-U format, so that
+    the UDPipe step does not have to tokenise the text a second time
+    """
+
+    # Output is sentence segmented and word tokenised
+    tokenizes = True
+
+    def __init__(self, model):
+        self.model = res.get_udpipe_model(model)
+        self.tokenizer = self.model.new_tokenizer('normalized_spaces')
+
+
+    def tokenize(self, textlist):
+        """
+        Tokenise the (non-empty) paragraphs, return a list of ufal.udpipe.Sentence-s
+        Paragraphs are separated by an empty line, so that no sentence
+        spans two paragraphs
+        """
+        text = '\n\n'.join(t for t in textlist if t != '')
+        if text == '':
+            return []
+        return self.model.tokenize(text, self.tokenizer)
+
+
+    def segment(self, textlist):
+        """
+        Split each (non-empty) paragraph into sentences
+        Return a list of sentence strings
+        """
+        return [self.sentence_text(s) for s in self.tokenize(textlist)]
+
+
+    def segment_and_tokenize(self, textlist):
+        """
+        Return a list of sentence strings, and the tokenised sentences in CoNLL-U format
+        """
+        sentences = self.tokenize(textlist)
+        segs = [self.sentence_text(s) for s in sentences]
+        return (segs, self.model.write(sentences, 'conllu'))
+
+
+    def sentence_text(self, sentence):
+        """
+        Reconstruct the text of a sentence from its tokens
+        Multi-word tokens (e.g. "im") are used in place of their parts ("in dem")
+        """
+        mwts = {}
+        for mwt in sentence.multiwordTokens:
+            mwts[mwt.idFirst] = mwt
+        text = []
+        i = 1
+        while i < len(sentence.words):
+            if i in mwts:
+                token = mwts[i]
+                i = token.idLast + 1
+            else:
+                token = sentence.words[i]
+                i += 1
+            text.append(token.form)
+            if 'SpaceAfter=No' not in token.misc:
+                text.append(' ')
+        return ''.join(text).rstrip()
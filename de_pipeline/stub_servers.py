@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-ins for the Stanford NER server and the AGDISTIS server
+
+The stub servers speak the same protocols as the real servers, so that the
+pipeline can be run, benchmarked and load-tested without them:
+    * NER: one request per TCP connection; the client sends a line of
+      whitespace-tokenised text and the server replies with the tokens in
+      slashTags format (token/TAG) and closes the connection
+    * AGDISTIS: HTTP POST of the form fields "text" (with entities marked
+      by <entity></entity> tags) and "type"; the reply is a JSON list of
+      entities with start and offset (character positions in the text without
+      the tags), namedEntity and disambiguatedURL
+Answers are deterministic and taken from a dictionary of entities (a tab
+separated file: surface form, NER type, DBPedia URL, FIGER type). Entities
+that are not in the dictionary are tagged O by the NER stub and linked to
+a notInWiki URL by the AGDISTIS stub.
+
+The response time of each request is drawn from a latency distribution
+(fixed, uniform, exponential or lognormal) around a mean that grows with the
+number of tokens (NER) or entities (AGDISTIS) in the request. A fraction of
+requests fail (the NER stub closes the connection without replying, the
+AGDISTIS stub returns an HTTP 500 error), and each server handles at most a
+given number of requests at a time (the NER server is a single JVM thread
+by default); further requests wait.
+
+To start the servers, use the command: python stub_servers.py [options]
+(see python stub_servers.py --help)
+"""
+
+# Standard
+import re
+import sys
+import time
+import gzip
+import codecs
+import random
+import argparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+import simplejson as json
+
+
+# Entities known to the stub servers if no dictionary file is given:
+# (surface form, NER type, DBPedia URL, FIGER type)
+DEFAULT_DICTIONARY = [
+    (u'Angela Merkel', 'PER', u'http://de.dbpedia.org/resource/Angela_Merkel', '/person/politician'),
+    (u'Merkel', 'PER', u'http://de.dbpedia.org/resource/Angela_Merkel', '/person/politician'),
+    (u'Berlin', 'LOC', u'http://de.dbpedia.org/resource/Berlin', '/location/city'),
+    (u'Deutschland', 'LOC', u'http://de.dbpedia.org/resource/Deutschland', '/location/country'),
+    (u'Frankreich', 'LOC', u'http://de.dbpedia.org/resource/Frankreich', '/location/country'),
+    (u'Bundesregierung', 'ORG', u'http://de.dbpedia.org/resource/Bundesregierung_(Deutschland)', '/government'),
+    (u'Europäische Union', 'ORG', u'http://de.dbpedia.org/resource/Europäische_Union', '/organization'),
+    (u'Siemens', 'ORG', u'http://de.dbpedia.org/resource/Siemens', '/organization/company'),
+]
+
+
+def read_dictionary(filename):
+    """
+    Read a dictionary file (tab separated: surface form, NER type, DBPedia URL, FIGER type)
+    """
+    entries = []
+    with codecs.open(filename, 'r', 'utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3 or line.startswith('#'):
+                continue
+            figer = fields[3] if len(fields) > 3 else ''
+            entries.append((fields[0], fields[1], fields[2], figer))
+    return entries
+
+
+class EntityDictionary():
+
+    """
+    Entities known to the stub servers
+    """
+
+    def __init__(self, entries):
+        # Token sequence -> NER type
+        self.ner_types = {}
+        # Surface form -> DBPedia URL
+        self.urls = {}
+        # DBPedia URL -> FIGER type
+        self.figer_types = {}
+        for (surface, ner_type, url, figer) in entries:
+            self.ner_types[tuple(surface.split())] = ner_type
+            self.urls[surface] = url
+            self.figer_types[url] = figer
+        self.max_length = max([len(k) for k in self.ner_types] + [1])
+
+
+    def ner_tags(self, tokens):
+        """
+        Tag a list of tokens with the (longest) dictionary entities, in BIO format
+        """
+        tags = ['O'] * len(tokens)
+        x = 0
+        while x < len(tokens):
+            for length in range(min(self.max_length, len(tokens)-x), 0, -1):
+                ner_type = self.ner_types.get(tuple(tokens[x:x+length]))
+                if ner_type is not None:
+                    tags[x] = 'B-' + ner_type
+                    for y in range(x+1, x+length):
+                        tags[y] = 'I-' + ner_type
+                    x += length
+                    break
+            else:
+                x += 1
+        return tags
+
+
+    def disambiguate(self, surface):
+        """
+        Return the DBPedia URL of an entity
+        """
+        if surface in self.urls:
+            return self.urls[surface]
+        return u'http://aksw.org/notInWiki/' + surface.replace(' ', '_')
+
+
+class StubBehaviour():
+
+    """
+    Response times, error rate and concurrency limit of a stub server
+    The mean response time of a request is latency + unit_latency * units
+    (units are tokens or entities)
+    """
+
+    def __init__(self, distribution, latency, unit_latency, error_rate, concurrency, seed):
+        self.distribution = distribution
+        self.latency = latency
+        self.unit_latency = unit_latency
+        self.error_rate = error_rate
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+
+    def response_time(self, units):
+        """
+        Draw the response time of a request from the latency distribution
+        """
+        mean = self.latency + self.unit_latency * units
+        with self.lock:
+            if self.distribution == 'uniform':
+                return self.random.uniform(0, 2 * mean)
+            if self.distribution == 'exponential':
+                return self.random.expovariate(1.0 / mean) if mean > 0 else 0.0
+            if self.distribution == 'lognormal':
+                # Lognormal with the given mean and shape (sigma) 0.5
+                return self.random.lognormvariate(0, 0.5) * mean / 1.1331
+            return mean
+
+
+    def fails(self):
+        """
+        Decide whether a request fails, and count the request
+        """
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+
+class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class NerHandler(SocketServer.StreamRequestHandler):
+
+    """
+    Handle a request to the NER stub server
+    """
+
+    def handle(self):
+        text = self.rfile.readline().decode('utf-8')
+        tokens = text.split()
+        stub = self.server.stub
+        with stub.slots:
+            time.sleep(stub.response_time(len(tokens)))
+            if stub.fails():
+                return
+            tags = self.server.dictionary.ner_tags(tokens)
+            response = ' '.join(tok + '/' + tag for tok, tag in zip(tokens, tags))
+            self.wfile.write(response.encode('utf-8'))
+
+
+class AgdistisHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Handle a request to the AGDISTIS stub server (connections are kept alive)
+    """
+
+    protocol_version = 'HTTP/1.1'
+    entity_pattern = re.compile(u'<entity>(.*?)</entity>', re.DOTALL)
+
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        text = form.get('text', [''])[0].decode('utf-8')
+        entities = []
+        # Character offsets refer to the text without the entity tags
+        removed = 0
+        for match in self.entity_pattern.finditer(text):
+            surface = match.group(1)
+            start = match.start() - removed
+            removed += len('<entity>') + len('</entity>')
+            entities.append({'namedEntity': surface, 'start': start, 'offset': len(surface),
+                             'disambiguatedURL': self.server.dictionary.disambiguate(surface)})
+        stub = self.server.stub
+        with stub.slots:
+            time.sleep(stub.response_time(len(entities)))
+            if stub.fails():
+                self.reply(500, 'text/html', '<html><body>Internal server error</body></html>')
+                return
+            self.reply(200, 'application/json', json.dumps(entities, ensure_ascii=False).encode('utf-8'))
+
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type+'; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_type_map(dictionary, filename):
+    """
+    Write the DBPedia to FIGER mapping of the dictionary entities, in the format
+    of the TypeMapping map_file (gzipped JSON), so that the NEL step can be run
+    """
+    with gzip.open(filename, 'w') as f:
+        json.dump(dictionary.figer_types, f)
+
+
+def start_server(server_class, port, handler, dictionary, stub):
+    """
+    Start a stub server in a background thread
+    """
+    server = server_class(('', port), handler)
+    server.dictionary = dictionary
+    server.stub = stub
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Local stand-ins for the Stanford NER and AGDISTIS servers')
+    argparser.add_argument('--dictionary', help='entity dictionary (tab separated: surface form, NER type, '
+                           'DBPedia URL, FIGER type); a small built-in dictionary is used by default')
+    argparser.add_argument('--write-type-map', metavar='FILE',
+                           help='write the DBPedia to FIGER mapping of the dictionary (gzipped JSON) to FILE')
+    argparser.add_argument('--ner-port', type=int, default=9199, help='NER server port, 0 to disable (default: 9199)')
+    argparser.add_argument('--agdistis-port', type=int, default=8080,
+                           help='AGDISTIS server port, 0 to disable (default: 8080)')
+    argparser.add_argument('--distribution', choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+                           default='lognormal', help='response time distribution (default: lognormal)')
+    argparser.add_argument('--ner-latency', type=float, default=0.005,
+                           help='mean NER response time per request, in seconds (default: 0.005)')
+    argparser.add_argument('--ner-token-latency', type=float, default=0.0002,
+                           help='mean NER response time per token, in seconds (default: 0.0002)')
+    argparser.add_argument('--agdistis-latency', type=float, default=0.02,
+                           help='mean AGDISTIS response time per request, in seconds (default: 0.02)')
+    argparser.add_argument('--agdistis-entity-latency', type=float, default=0.01,
+                           help='mean AGDISTIS response time per entity, in seconds (default: 0.01)')
+    argparser.add_argument('--ner-error-rate', type=float, default=0.0,
+                           help='fraction of NER requests that fail (default: 0)')
+    argparser.add_argument('--agdistis-error-rate', type=float, default=0.0,
+                           help='fraction of AGDISTIS requests that fail (default: 0)')
+    argparser.add_argument('--ner-concurrency', type=int, default=1,
+                           help='number of NER requests handled at a time (default: 1)')
+    argparser.add_argument('--agdistis-concurrency', type=int, default=8,
+                           help='number of AGDISTIS requests handled at a time (default: 8)')
+    argparser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
+    args = argparser.parse_args()
+
+    entries = read_dictionary(args.dictionary) if args.dictionary else DEFAULT_DICTIONARY
+    dictionary = EntityDictionary(entries)
+    if args.write_type_map:
+        write_type_map(dictionary, args.write_type_map)
+    servers = []
+    if args.ner_port:
+        stub = StubBehaviour(args.distribution, args.ner_latency, args.ner_token_latency,
+                             args.ner_error_rate, args.ner_concurrency, args.seed)
+        servers.append(('NER', start_server(ThreadedTCPServer, args.ner_port, NerHandler, dictionary, stub)))
+        print('NER stub server listening on port %d' % args.ner_port)
+    if args.agdistis_port:
+        stub = StubBehaviour(args.distribution, args.agdistis_latency, args.agdistis_entity_latency,
+                             args.agdistis_error_rate, args.agdistis_concurrency, args.seed)
+        servers.append(('AGDISTIS', start_server(ThreadedHTTPServer, args.agdistis_port, AgdistisHandler,
+                                                 dictionary, stub)))
+        print('AGDISTIS stub server listening on port %d' % args.agdistis_port)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for name, server in servers:
+            print('%s: %d requests, %d errors' % (name, server.stub.requests, server.stub.errors))
+            server.shutdown()
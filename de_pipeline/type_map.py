@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact, memory-mapped DBPedia to FIGER type map
+
+The map is compiled into a single file that is memory-mapped by every
+process that uses it, so that all worker processes share one copy of it
+through the page cache, and loading it takes no time. File layout:
+    * header: MAGIC
+    * records: "<DBPedia URL>\t<FIGER type>\n" (UTF-8), sorted by URL
+    * index: the file offset of each record (little-endian uint64)
+    * footer: offset of the index and number of records (little-endian
+      uint64 each), followed by MAGIC
+URLs are looked up by binary search over the index. TypeMap supports the
+dictionary operations used by the pipeline (tm[url], url in tm, tm.get(url)).
+
+To compile a map from the gzipped JSON format, use the command:
+python type_map.py <map.json.gz> <output file>
+"""
+
+# Standard
+import os
+import sys
+import gzip
+import mmap
+import struct
+import tempfile
+import numpy as np
+import simplejson as json
+
+
+MAGIC = 'DBFIGER1'
+FOOTER = struct.Struct('<QQ8s')
+
+
+def write_type_map(items, path):
+    """
+    Write a type map to path, from an iterable of (DBPedia URL, FIGER type)
+    pairs sorted by URL (UTF-8 encoded strings)
+    The file is written under a temporary name and renamed when complete,
+    so that readers never see a partly written map
+    """
+    outdir = os.path.dirname(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(dir=outdir, prefix='.'+os.path.basename(path))
+    try:
+        offsets = []
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            position = len(MAGIC)
+            previous = None
+            for url, figer in items:
+                if previous is not None and url <= previous:
+                    raise ValueError("Type map keys not sorted or not unique: '%s' after '%s'" % (url, previous))
+                if '\t' in url or '\n' in url or '\n' in figer:
+                    raise ValueError("Invalid type map entry: '%s'" % url)
+                record = url + '\t' + figer + '\n'
+                offsets.append(position)
+                f.write(record)
+                position += len(record)
+                previous = url
+            f.write(np.asarray(offsets, dtype='<u8').tostring())
+            f.write(FOOTER.pack(position, len(offsets), MAGIC))
+        # mkstemp creates the file readable by its owner only: give the map
+        # the permissions of a file created with open(), so that other users
+        # can read it
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmppath, 0o666 & ~umask)
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def compile_json_type_map(jsonfile, path):
+    """
+    Compile a type map in the gzipped JSON format (as produced by earlier
+    versions of scripts/DBPedia_to_FIGER.py) into the memory-mapped format
+    """
+    with gzip.open(jsonfile, 'r') as f:
+        m = json.load(f)
+    items = sorted((url.encode('utf-8'), figer.encode('utf-8')) for url, figer in m.iteritems())
+    write_type_map(items, path)
+
+
+def is_type_map(path):
+    """
+    Check whether a file is a compiled (memory-mapped format) type map
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class TypeMap():
+
+    """
+    Read-only, memory-mapped DBPedia to FIGER type map
+    URLs may be given as UTF-8 encoded or unicode strings; types are
+    returned as unicode strings
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, count, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if self.map[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise IOError("'%s' is not a compiled type map" % path)
+        self.count = count
+        self.index = np.frombuffer(self.map, dtype='<u8', count=count, offset=index_offset)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def find(self, url):
+        """
+        Return the file offset of the type of url, or -1 if url is not in the map
+        """
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = int(self.index[mid])
+            end = self.map.find('\t', start)
+            key = self.map[start:end]
+            if key < url:
+                lo = mid + 1
+            elif key > url:
+                hi = mid
+            else:
+                return end + 1
+        return -1
+
+
+    def __contains__(self, url):
+        return self.find(url) >= 0
+
+
+    def __getitem__(self, url):
+        position = self.find(url)
+        if position < 0:
+            raise KeyError(url)
+        return self.map[position:self.map.find('\n', position)].decode('utf-8')
+
+
+    def get(self, url, default=None):
+        position = self.find(url)
+        if position < 0:
+            return default
+        return self.map[position:self.map.find('\n', position)].decode('utf-8')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print('usage: python type_map.py <map.json.gz> <output file>')
+        sys.exit(1)
+    compile_json_type_map(sys.argv[1], sys.argv[2])
@@ -30,14 +30,46 @@ class UDPipeModel:
             raise Exception("Cannot load UDPipe model from file '%s'" % path)
 
         
-    def tokenize(self, text):
-        """Tokenize the text and return list of ufal.udpipe.Sentence-s."""
-        tokenizer = self.model.newTokenizer("normalized_spaces;presegmented")
+    def new_tokenizer(self, options="normalized_spaces;presegmented"):
+        """Create a tokenizer with the given options (reusable across calls to tokenize)."""
+        tokenizer = self.model.newTokenizer(options)
         if not tokenizer:
             raise Exception("The model does not have a tokenizer")
+        return tokenizer
+
+
+    def tokenize(self, text, tokenizer=None):
+        """Tokenize the text and return list of ufal.udpipe.Sentence-s."""
+        if tokenizer is None:
+            tokenizer = self.new_tokenizer()
         return self._read(text, tokenizer)
 
 
+    def tokenize_stream(self, chunks, tokenizer=None):
+        """Tokenize each text chunk (e.g. line of presegmented text) in turn and yield ufal.udpipe.Sentence-s."""
+        if tokenizer is None:
+            tokenizer = self.new_tokenizer()
+        return self._read_stream(chunks, tokenizer)
+
+
+    def read(self, text, in_format):
+        """Load text in the given format (conllu|horizontal|vertical) and return list of ufal.udpipe.Sentence-s."""
+        return self._read(text, self._input_format(in_format))
+
+
+    def read_stream(self, chunks, in_format):
+        """Load each text chunk (e.g. CoNLL-U sentence block) in the given format in turn and yield ufal.udpipe.Sentence-s."""
+        return self._read_stream(chunks, self._input_format(in_format))
+
+
+    def _input_format(self, in_format):
+        """Create an input format reader"""
+        input_format = InputFormat.newInputFormat(in_format)
+        if not input_format:
+            raise Exception("Cannot create input format '%s'" % in_format)
+        return input_format
+
+
     def _read(self, text, input_format):
         """Read sentences"""
         input_format.setText(text)
@@ -51,6 +83,19 @@ class UDPipeModel:
             raise Exception(error.message)
         return sentences
 
+
+    def _read_stream(self, chunks, input_format):
+        """Read sentences chunk by chunk, yielding each sentence as soon as it is read"""
+        error = ProcessingError()
+        for chunk in chunks:
+            input_format.setText(chunk)
+            sentence = Sentence()
+            while input_format.nextSentence(sentence, error):
+                yield sentence
+                sentence = Sentence()
+            if error.occurred():
+                raise Exception(error.message)
+
     
     def tag(self, sentence):
         """Tag the given ufal.udpipe.Sentence (inplace)."""
@@ -65,8 +110,18 @@ class UDPipeModel:
     def write(self, sentences, out_format):
         """Write given ufal.udpipe.Sentence-s in the required format (conllu|horizontal|vertical)."""
         output_format = OutputFormat.newOutputFormat(out_format)
-        output = ''
+        output = [output_format.writeSentence(sentence) for sentence in sentences]
+        output.append(output_format.finishDocument())
+        return ''.join(output)
+
+
+    def write_stream(self, sentences, out_format, outfile):
+        """Write each of the given ufal.udpipe.Sentence-s to outfile in the required format as soon as it is available.
+        Return the number of sentences written."""
+        output_format = OutputFormat.newOutputFormat(out_format)
+        count = 0
         for sentence in sentences:
-            output += output_format.writeSentence(sentence)
-        output += output_format.finishDocument()
-        return output
+            outfile.write(output_format.writeSentence(sentence))
+            count += 1
+        outfile.write(output_format.finishDocument())
+        return count
@@ -7,35 +7,65 @@ import sys
 import codecs 
 
 
+# Raised when the parsed file does not line up with the original file
+class AlignmentError(ValueError):
+    pass
+
+
 # Restore multi-token spans e.g. add back in "im" ("in dem") for German
+# The original file (output by UDPipe) and the file parsed by the UnstableParser
+# are read in lockstep, one line at a time, so memory use does not depend on the
+# size of the files. Each word of the original file must match the next line of
+# the parsed file (same token ID), and each sentence end an empty line, otherwise
+# an AlignmentError is raised with the sentence number
+# The output is written to a temporary file, renamed when the merge is complete,
+# so that a failed merge leaves no output file (which a resumed run would read)
 def restore(original_file, input_file, output_dir):
-    lines = []
+    infilename = input_file.split('/')[-1]
+    output_file = output_dir+'/'+infilename
+    tmp_file = output_dir+'/.'+infilename+'.tmp'
+    try:
+        with codecs.open(original_file, encoding='utf-8') as f, \
+             codecs.open(input_file, encoding='utf-8') as parsed, \
+             codecs.open(tmp_file, 'w', encoding='utf-8') as fout:
+            merge(f, parsed, fout, input_file)
+        os.rename(tmp_file, output_file)
+    except:
+        for name in [tmp_file, output_file]:
+            if os.path.exists(name):
+                os.remove(name)
+        raise
 
-    # Read the file parsed by the UnstableParser
-    with codecs.open(input_file, encoding='utf-8') as f: 
-        for line in f: 
-            lines.append(line) 
- 
-    # Read the original file (output by UDPipe)
-    with codecs.open(original_file, encoding='utf-8') as f:
-        infilename = input_file.split('/')[-1]
-        output_file = output_dir+'/'+infilename
-        # Write to the output file (restored parser output)
-        with codecs.open(output_file, 'w', encoding='utf-8') as fout: 
-            i = 0 
-            for line in f: 
-                line = line.strip() 
-                if len(line) == 0: 
-                    fout.write(lines[i]) 
-                    i += 1 
-                    continue 
-                if line[0] == '#': 
-                    continue 
-                line = line.split('\t') 
-                if '.' in line[0]: 
-                    continue 
-                if '-' in line[0]: 
-                    fout.write('%s\n' % ('\t'.join(line))) 
-                    continue
-                fout.write(lines[i])
-                i += 1
+
+def merge(f, parsed, fout, input_file):
+    sentence = 1
+    for line in f:
+        line = line.strip()
+        if len(line) == 0:
+            parsed_line = next(parsed, None)
+            if parsed_line is None or parsed_line.strip() != '':
+                raise misaligned(input_file, sentence, 'end of sentence', parsed_line)
+            fout.write(parsed_line)
+            sentence += 1
+            continue
+        if line[0] == '#':
+            continue
+        line = line.split('\t')
+        if '.' in line[0]:
+            continue
+        if '-' in line[0]:
+            fout.write('%s\n' % ('\t'.join(line)))
+            continue
+        parsed_line = next(parsed, None)
+        if parsed_line is None or parsed_line.split('\t')[0].strip() != line[0]:
+            raise misaligned(input_file, sentence, 'token '+line[0], parsed_line)
+        fout.write(parsed_line)
+    for parsed_line in parsed:
+        if parsed_line.strip() != '':
+            raise misaligned(input_file, sentence, 'end of file', parsed_line)
+
+
+def misaligned(input_file, sentence, expected, parsed_line):
+    found = 'end of file' if parsed_line is None else repr(parsed_line.rstrip('\n'))
+    return AlignmentError('%s is misaligned with the original file at sentence %d: expected %s, found %s' %
+                          (input_file, sentence, expected, found))
@@ -1,68 +1,144 @@
 # Script to produce a mapping from DBPedia links output by the
 # named entity linker (AGDISTIS) to FIGER types (via Freebase)
+#
+# The inputs are streamed and joined on the Freebase URL (MID) by external
+# sorting and merging, so memory use does not depend on the size of the dumps:
+#   1) DBPedia -> Freebase links (freebase_links_de.ttl.gz, from the DBPedia dump)
+#      are sorted by Freebase URL
+#   2) Freebase entity types (entity2type_names.txt.gz) are mapped to their
+#      first FIGER type (using types.map.gz) and sorted by Freebase URL
+#   3) the two are merged, and the result is sorted by DBPedia URL and written
+#      in the compiled (memory-mapped) type map format read by the pipeline
+# Where an input contains several entries for the same URL, the last one is used.
+# The sorted outputs of steps 1 and 2 are kept in the work directory, with a
+# stamp recording the inputs they were built from, so that when only one of
+# the dumps changes only its step (and step 3) is run again.
+#
+# To run the script, use the command:
+# python scripts/DBPedia_to_FIGER.py --links <path>/freebase_links_de.ttl.gz --output <path>/dbpedia_figer_map.tmap
 
+import os
+import sys
 import gzip
+import heapq
+import shutil
+import argparse
+import tempfile
+import itertools
 import simplejson as json
 
-# Set paths for output file and freebase external links file (to be downloaded from DBPedia dump)
-outputfile = '<path>/dbpedia_figer_map.json.gz'
-freebaselinkfile = '<path>/freebase_links_de.ttl.gz'
-freebasetypefile = 'data/entity2type_names.txt.gz'
-figertypefile = 'data/types.map.gz'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'de_pipeline'))
+import type_map as tm
 
-def dbpedia_url_to_freebase_url():
-    d_to_f = {}
-    flinks = {}
-    with gzip.open(freebaselinkfile, 'r') as f:
+# Change when the format of the intermediate files changes, to force a rebuild
+VERSION = 1
+
+
+def file_signature(filename):
+    """
+    Signature of an input file: path, size and modification time
+    """
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_size, int(st.st_mtime)]
+
+
+def is_up_to_date(outfile, signature):
+    """
+    Check whether an intermediate file was built from inputs with the given signature
+    """
+    if not os.path.exists(outfile) or not os.path.exists(outfile+'.stamp'):
+        return False
+    with open(outfile+'.stamp') as f:
+        return json.load(f) == signature
+
+
+def write_stamp(outfile, signature):
+    with open(outfile+'.stamp', 'w') as f:
+        json.dump(signature, f)
+
+
+def external_sort(lines, outfile, workdir, chunk_size):
+    """
+    Sort lines (each ending in a newline) with bounded memory: sort runs of
+    chunk_size lines in memory, write them to temporary files and merge them
+    The sorted lines are written to outfile (replaced when complete)
+    """
+    rundir = tempfile.mkdtemp(dir=workdir)
+    try:
+        runs = []
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if chunk == []:
+                break
+            chunk.sort()
+            runfile = os.path.join(rundir, str(len(runs)))
+            with open(runfile, 'w') as f:
+                f.writelines(chunk)
+            runs.append(runfile)
+            del chunk
+        files = [open(r) for r in runs]
+        try:
+            with open(outfile+'.tmp', 'w') as o:
+                o.writelines(heapq.merge(*files))
+        finally:
+            for f in files:
+                f.close()
+        os.rename(outfile+'.tmp', outfile)
+    finally:
+        shutil.rmtree(rundir)
+
+
+def read_records(filename):
+    """
+    Read a sorted intermediate file: yield (key, sequence number, value)
+    """
+    with open(filename) as f:
+        for line in f:
+            key, seq, value = line.rstrip('\n').split('\t')
+            yield key, seq, value
+
+
+def last_per_key(records):
+    """
+    Keep the last record (highest sequence number) for each key of sorted records
+    """
+    for key, group in itertools.groupby(records, key=lambda r: r[0]):
+        last = None
+        for last in group:
+            pass
+        yield last
+
+
+def freebase_links(linkfile):
+    """
+    Stream the DBPedia -> Freebase links file
+    Yield lines: Freebase URL, sequence number, DBPedia URL
+    """
+    with gzip.open(linkfile, 'r') as f:
+        seq = 0
         for line in f:
             if line[0] != '#':
                 elements = line.split(' ')
                 dbpedia_url = elements[0].lstrip('<').rstrip('>')
                 freebase_url = elements[2].lstrip('<').rstrip('>')
-                d_to_f[dbpedia_url] = freebase_url
-                flinks[freebase_url] = ''
-    return d_to_f, flinks
+                yield '%s\t%012d\t%s\n' % (freebase_url, seq, dbpedia_url)
+                seq += 1
 
-def freebase_url_to_type(u_to_t):
-    ftypes = {}
-    with gzip.open(freebasetypefile, 'r') as f:
-        for line in f:
-            line = line.rstrip('\n')
-            elements = line.split('\t')
-            mid = elements[0].replace('/','.').lstrip('.')
-            freebase_url = 'http://rdf.freebase.com/ns/' + mid
-            freebase_types = elements[3].replace('  ',' ').split(' ') 
-            if freebase_url in u_to_t:
-                u_to_t[freebase_url] = freebase_types
-            for t in freebase_types:
-                if t not in ftypes:
-                    ftypes[t] = ''
-    return u_to_t, ftypes
-
-def freebase_type_to_figer_type(f_to_f):
+
+def freebase_type_to_figer_type(figertypefile):
+    """
+    Read the Freebase type -> FIGER type mapping (small enough to be held in memory)
+    Using mapping from: https://github.com/xiaoling/figer
+    """
+    f_to_f = {}
     with gzip.open(figertypefile, 'r') as f:
         for line in f:
             line = line.rstrip('\n')
             elements = line.split('\t')
-            if elements[0] in f_to_f:
+            if len(elements) > 1:
                 f_to_f[elements[0]] = elements[1]
     return f_to_f
 
-def dbpedia_to_figer(dbpedia,freebase,figer):
-    m = {}
-    for dbplink in dbpedia:
-        freebase_type = []
-        figer_type = []
-        freebase_url = dbpedia[dbplink]
-        if freebase_url in freebase:
-            freebase_type = freebase[freebase_url]
-        for ft in freebase_type:
-            if ft in figer and figer[ft] != '':
-                figer_type.append(figer[ft])
-            else:
-                figer_type.append('')
-        m[dbplink] = get_first_non_empty_figer(figer_type)
-    return m
 
 def get_first_non_empty_figer(l):
     for t in l:
@@ -70,18 +146,89 @@ def get_first_non_empty_figer(l):
             return t
     return ''
 
-# Get DBPedia url -> Freebase url links (from DBPedia Freebase links)
-res = dbpedia_url_to_freebase_url()
-dbpedia_to_freebase = res[0]
-freebaselinks = res[1]
-# Get Freebase type(s) from Freebase (using mapping file from Javad)
-res = freebase_url_to_type(freebaselinks)
-freebase_url_to_type = res[0]
-freebasetypes = res[1]
-# Get FIGER type from Freebase type
-# Using mapping from: https://github.com/xiaoling/figer
-freebase_to_figer = freebase_type_to_figer_type(freebasetypes)
-map_to_figer = dbpedia_to_figer(dbpedia_to_freebase,freebase_url_to_type,freebase_to_figer)
-# Output mapping to file
-with gzip.open(outputfile, 'w') as o:
-    json.dump(map_to_figer, o)
+
+def freebase_figer_types(freebasetypefile, figer):
+    """
+    Stream the Freebase entity types file, mapping the types of each entity to its first FIGER type
+    Yield lines: Freebase URL, sequence number, FIGER type
+    """
+    with gzip.open(freebasetypefile, 'r') as f:
+        seq = 0
+        for line in f:
+            line = line.rstrip('\n')
+            elements = line.split('\t')
+            mid = elements[0].replace('/','.').lstrip('.')
+            freebase_url = 'http://rdf.freebase.com/ns/' + mid
+            freebase_types = elements[3].replace('  ',' ').split(' ')
+            figer_type = get_first_non_empty_figer([figer.get(ft, '') for ft in freebase_types])
+            yield '%s\t%012d\t%s\n' % (freebase_url, seq, figer_type)
+            seq += 1
+
+
+def dbpedia_figer_types(linksfile, typesfile):
+    """
+    Merge the sorted links and types files on the Freebase URL
+    Yield lines: DBPedia URL, sequence number (of the link), FIGER type
+    """
+    types = last_per_key(read_records(typesfile))
+    current = next(types, None)
+    for freebase_url, seq, dbpedia_url in read_records(linksfile):
+        while current is not None and current[0] < freebase_url:
+            current = next(types, None)
+        figer_type = current[2] if current is not None and current[0] == freebase_url else ''
+        yield '%s\t%s\t%s\n' % (dbpedia_url, seq, figer_type)
+
+
+def build(args):
+    """
+    Build the DBPedia -> FIGER type map, re-running only the steps whose inputs changed
+    """
+    workdir = args.work_dir or os.path.dirname(os.path.abspath(args.output))
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    linksfile = os.path.join(workdir, 'dbpedia_freebase_links.sorted')
+    typesfile = os.path.join(workdir, 'freebase_figer_types.sorted')
+    mapfile = os.path.join(workdir, 'dbpedia_figer_types.sorted')
+    links_signature = [VERSION, file_signature(args.links)]
+    types_signature = [VERSION, file_signature(args.entity_types), file_signature(args.figer_types)]
+    # Get DBPedia url -> Freebase url links (from DBPedia Freebase links), sorted by Freebase url
+    if is_up_to_date(linksfile, links_signature):
+        print('links unchanged, reusing '+linksfile)
+    else:
+        print('sorting links: '+args.links)
+        external_sort(freebase_links(args.links), linksfile, workdir, args.chunk_size)
+        write_stamp(linksfile, links_signature)
+    # Get FIGER type from Freebase type(s) (using mapping file from Javad), sorted by Freebase url
+    if is_up_to_date(typesfile, types_signature):
+        print('entity types unchanged, reusing '+typesfile)
+    else:
+        print('sorting entity types: '+args.entity_types)
+        figer = freebase_type_to_figer_type(args.figer_types)
+        external_sort(freebase_figer_types(args.entity_types, figer), typesfile, workdir, args.chunk_size)
+        write_stamp(typesfile, types_signature)
+    # Join on Freebase url, sort by DBPedia url and write the compiled map
+    map_signature = [VERSION, links_signature, types_signature]
+    if is_up_to_date(mapfile, map_signature) and os.path.exists(args.output):
+        print('mapping unchanged: '+args.output)
+        return
+    print('merging')
+    external_sort(dbpedia_figer_types(linksfile, typesfile), mapfile, workdir, args.chunk_size)
+    write_stamp(mapfile, map_signature)
+    print('writing '+args.output)
+    tm.write_type_map(((r[0], r[2]) for r in last_per_key(read_records(mapfile))), args.output)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Build the DBPedia to FIGER type mapping file')
+    argparser.add_argument('--links', required=True,
+                           help='DBPedia to Freebase links file (freebase_links_de.ttl.gz, from the DBPedia dump)')
+    argparser.add_argument('--entity-types', default='data/entity2type_names.txt.gz',
+                           help='Freebase entity types file (default: data/entity2type_names.txt.gz)')
+    argparser.add_argument('--figer-types', default='data/types.map.gz',
+                           help='Freebase type to FIGER type mapping file (default: data/types.map.gz)')
+    argparser.add_argument('--output', required=True, help='output (compiled) mapping file')
+    argparser.add_argument('--work-dir', help='directory for the intermediate sorted files, '
+                           'kept for incremental rebuilds (default: the directory of the output file)')
+    argparser.add_argument('--chunk-size', type=int, default=1000000,
+                           help='number of lines sorted in memory at a time (default: 1000000)')
+    build(argparser.parse_args())